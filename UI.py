@@ -6,37 +6,60 @@ User Interface for analyze fluorescence images taken by TIRFM
 Primarily made for Calcium Influx Assay (Liposome Assay) project
 
 This is a User Interface code, which must work with local_tools.py in the same folder.
+The analysis modules are imported in the background after the window opens.
 
 Created by Zengjie Xia in July 2019.
 Copyright © 2019 Zengjie Xia. All rights reserved.
 Version: 2.0
 """
 
-import local_tools
 from tkinter import *
 from tkinter import ttk
 import tkinter.messagebox as tkmbox
 from tkinter import filedialog
 import tkinter.scrolledtext as scrolledtext
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 from itertools import compress
 import datetime
+import math
 import os
 import locale
 import time
 import shutil
+import threading
+import queue
+from collections import deque
 locale.setlocale(locale.LC_ALL, '')
 
+# The analysis modules (numpy, pandas, scipy and tifffile through local_tools) take
+# most of the start-up time, so they are imported by load_modules once the window shows.
+np = pd = local_tools = result_sink = dataset_index = field_cache = None
+
+
+def load_modules():
+	"""
+	import the analysis modules into this module
+	Run on a background thread as soon as the window is up; the analysis calls it
+	again, which waits for an import still running on the other thread.
+	"""
+	global np, pd, local_tools, result_sink, dataset_index, field_cache
+	import numpy as np
+	import pandas as pd
+	import local_tools
+	import result_sink
+	import dataset_index
+	import field_cache
+
 
 Holder = {
 	'PATH' : os.path.dirname(os.path.abspath(__file__)),
 	'Threshold' : '80',
 	'Radius' : '3',
 	'High' : 200,
-	'Low' : -100
+	'Low' : -100,
+	'Incremental' : True, # reuse the cached tables of fields whose inputs, threshold and radius did not change, Results is kept
+	'HashInputs' : False, # identify input files by content hash instead of size and modification time
+	'FrameCache' : True, # keep averaged and aligned images in PATH/.frame_cache, shared with main.py
+	'FrameCacheSize' : 2 # size limit of the frame cache in GB
 }
 
 # Holder['PATH'] = r'C:\Users\zx252\Documents\Projects\Calcium_Influx_Image_Analysis\20190315_pd_samples'
@@ -50,7 +73,7 @@ class UserInterface(Frame):
 		Frame.__init__(self, master)
 		# Master interface
 		self.master = master
-		master.geometry('660x240')
+		master.geometry('660x260')
 		master.resizable(True, True) 
 		master.title('Calcium Influx Analysis')
 
@@ -87,10 +110,24 @@ class UserInterface(Frame):
 		self.radius_entry.bind('<FocusOut>', self.updateRadius)
 		self.radius_entry.grid(row=2, column=1, sticky=E+W)
 
-			# Start
-		Button(self.control_frame, text='Start', anchor=CENTER, command=self.start).grid(row=1, rowspan=2, column=2, sticky=E+W+S+N)	
-
-		ttk.Separator(self.control_frame, orient='horizontal').grid(row=3, column=0, columnspan=3, sticky=E+W)
+			# Start, Pause and Cancel
+		self.start_button = Button(self.control_frame, text='Start', anchor=CENTER, command=self.start)
+		self.start_button.grid(row=1, column=2, sticky=E+W+S+N)
+		self.run_frame = Frame(self.control_frame)
+		self.run_frame.grid(row=2, column=2, sticky=E+W)
+		self.pause_button = Button(self.run_frame, text='Pause', anchor=CENTER, command=self.pause, width='6', state='disabled')
+		self.pause_button.pack(side=LEFT, fill=X, expand=True)
+		self.cancel_button = Button(self.run_frame, text='Cancel', anchor=CENTER, command=self.cancel, width='6', state='disabled')
+		self.cancel_button.pack(side=LEFT, fill=X, expand=True)
+
+			# Progress
+		Label(self.control_frame, text='Progress:', anchor=E).grid(row=3, column=0, sticky=E)
+		self.progress_var = StringVar()
+		self.progress_var.set('Not started')
+		Label(self.control_frame, textvariable=self.progress_var, anchor=W).grid(row=3, column=1, columnspan=2, sticky=E+W)
+		self.worker = None
+
+		ttk.Separator(self.control_frame, orient='horizontal').grid(row=4, column=0, columnspan=3, sticky=E+W)
 
 		# Status Frame
 		self.status_frame = scrolledtext.ScrolledText(master, height=10, width=80)
@@ -99,6 +136,8 @@ class UserInterface(Frame):
 		self.status_frame.config(state="disabled")
 		self.updateStatus('If you encountered any problem, please try to restart. If can not be solved, contact me by email: zx252@cam.ac.uk')
 
+		threading.Thread(target=load_modules, daemon=True).start()
+
 		toc = time.time()
 		print('UI loading time: ' + str(toc-tik) + ' s')
 
@@ -185,8 +224,12 @@ class UserInterface(Frame):
 		self.master.update()
 
 	def start(self):
+		if self.worker is not None and self.worker.is_alive():
+			self.updateStatus('An analysis is already running.')
+			return 0
+
 		result_path = Holder['PATH'] + '/Results'
-		if os.path.isdir(result_path):
+		if os.path.isdir(result_path) and not Holder['Incremental']:
 			answer = tkmbox.askquestion(title='Pre-exist Result Folder', message='Result folder existed. Do you want to replace the old result?')
 			if answer == 'yes':
 				shutil.rmtree(result_path)
@@ -194,62 +237,211 @@ class UserInterface(Frame):
 				self.updateStatus('Programme terminated.')
 				return 0
 
-		os.makedirs(result_path)
-
-		thresholds = [int(thre) for thre in Holder['Threshold'].split('/')]
-		sample_names = next(os.walk(Holder['PATH']))[1]
-		sample_names = [name for name in sample_names if name != 'Results']
-		self.summary = pd.DataFrame()
-
-		items = ['Main', 'Ionomycin', 'Sample', 'Blank']
-		est = 0
-		for name in sample_names:
-			if est == 0:
-					tic = time.time()
-
-			sample = local_tools.CalciumSample(Holder['PATH'] + '/' + name, Holder) 
+		os.makedirs(result_path, exist_ok=True)
+
+		self.worker = AnalysisWorker(dict(Holder), result_path)
+		self.start_button.config(state='disabled')
+		self.pause_button.config(state='normal', text='Pause')
+		self.cancel_button.config(state='normal')
+		self.worker.start()
+		self.master.after(100, self.pollWorker)
+
+	def pause(self):
+		if self.worker is None or not self.worker.is_alive():
+			return
+		if self.worker.resume.is_set():
+			self.worker.resume.clear()
+			self.pause_button.config(text='Resume')
+			self.updateStatus('Pausing after the current field.')
+		else:
+			self.worker.resume.set()
+			self.pause_button.config(text='Pause')
+			self.updateStatus('Resumed.')
+
+	def cancel(self):
+		if self.worker is None or not self.worker.is_alive():
+			return
+		self.worker.cancelled.set()
+		self.worker.resume.set()
+		self.updateStatus('Cancelling after the current field.')
+
+	def pollWorker(self):
+		"""
+		Show the events of the analysis worker, polled from the Tk main loop
+		"""
+		while True:
 			try:
-				error = sample.error_report['path'].index(0)
-			except ValueError:
-				self.updateStatus('Starting '+name)
+				event, value = self.worker.events.get_nowait()
+			except queue.Empty:
+				break
+
+			if event == 'status':
+				self.updateStatus(value)
+			elif event == 'progress':
+				done, total, eta = value
+				self.progress_var.set(str(done) + '/' + str(total) + ' fields' + ('' if eta is None else ', ETA ' + str(datetime.timedelta(seconds=math.ceil(eta)))))
+			elif event == 'done':
+				self.summary = value
+
+		if self.worker.is_alive() or not self.worker.events.empty():
+			self.master.after(100, self.pollWorker)
+		else:
+			self.start_button.config(state='normal')
+			self.pause_button.config(state='disabled', text='Pause')
+			self.cancel_button.config(state='disabled')
+
+
+class AnalysisWorker(threading.Thread):
+	"""
+	Runs the analysis of all samples off the Tk main thread.
+	Progress is sent as (event, value) tuples through 'events':
+		('status', text), ('progress', (done fields, total fields, ETA in s or None)), ('done', summary)
+	'resume' is cleared to pause and 'cancelled' set to stop, both take effect between fields.
+	The plate is found with the header-only dataset index, and the ETA comes from
+	the bytes of the recent fields and of the fields left.
+	With Holder['Incremental'] the table of every (sample, field, threshold) is kept in
+	result_path/.cache, keyed by its input files, threshold, radius, High, Low and the
+	frame settings, and only the fields with a missing table are analysed again.
+	"""
+
+	items = ['Main', 'Ionomycin', 'Sample', 'Blank']
+
+	def __init__(self, Holder, result_path, window=10):
+		"""
+		para: Holder - dict of settings, copied when the analysis starts
+		para: result_path - string
+		para: window - integer, number of recent fields the ETA is based on
+		"""
+		threading.Thread.__init__(self, daemon=True)
+		self.Holder = Holder
+		self.result_path = result_path
+		self.events = queue.Queue()
+		self.resume = threading.Event()
+		self.resume.set()
+		self.cancelled = threading.Event()
+		self.field_rates = deque(maxlen=window) # (seconds, bytes) of recent fields
+
+	def status(self, text):
+		self.events.put(('status', text))
+
+	def checkpoint(self):
+		"""
+		wait while paused
+		return: True if the analysis should stop
+		"""
+		self.resume.wait()
+		return self.cancelled.is_set()
+
+	def run(self):
+		try:
+			self.analyse()
+		except Exception as e:
+			self.status('ERROR: ' + repr(e))
+
+	def analyse(self):
+		tic = time.time()
+		load_modules()
+		thresholds = [int(thre) for thre in self.Holder['Threshold'].split('/')]
+		index = dataset_index.DatasetIndex(self.Holder['PATH']).scan()
+		for problem in index.problems:
+			if problem['field']:
+				self.status(problem['sample'] + '/' + problem['field'] + ' was skipped: ' + problem['reason'] + '.')
+		sample_names = index.sample_names()
+		unit_bytes = index.unit_bytes()
+
+		frameCache = None
+		if self.Holder.get('FrameCache', False):
+			frameCache = field_cache.FrameCache(self.Holder['PATH'] + '/.frame_cache', int(self.Holder.get('FrameCacheSize', 2)*1024**3), self.Holder.get('HashInputs', False))
+
+		### Cached tables of the fields, one unit per sample, field and threshold ###
+		manifest = None
+		if self.Holder.get('Incremental', False):
+			manifest = field_cache.FieldManifest(self.result_path + '/.cache', self.Holder.get('HashInputs', False))
+			params = {name: self.Holder.get(name, default) for name, default in local_tools.FRAME_SETTINGS.items()}
+			params.update({name: int(self.Holder[name]) for name in ['Radius', 'High', 'Low']})
+		units = [name + '/' + field + '/' + str(thre) for (name, field) in unit_bytes for thre in thresholds]
+
+		### Totals for the ETA from the index, a sample and its images are only held while it runs ###
+		total = len(unit_bytes)
+		remaining_bytes = sum(unit_bytes.values())
+		done = 0
+		self.events.put(('progress', (done, total, None)))
+
+		summary_rows = []
+		sink = result_sink.ResultSink(self.result_path)
+		try:
+			for name in sample_names:
+				sample = local_tools.CalciumSample(self.Holder['PATH'] + '/' + name, self.Holder, frameCache, fields=index.fields(name))
+				if 0 in sample.error_report['path']:
+					error_items = ', '.join(list(compress(self.items, np.subtract(1, sample.error_report['path']))))
+					self.status('Path error with ' + error_items + 'folder(s) in ' + name +'.\n'+name+' was skipped.')
+					continue
+				if len(sample.fields) == 0:
+					self.status('No field found in ' + name + '. ' + name + ' was skipped.')
+					summary_rows += [[name, thre, float('nan'), 0] for thre in thresholds]
+					continue
+
+				### Look up the tables which do not need to be computed again ###
+				tables, keys = {}, {}
+				if manifest is not None:
+					for c, field in enumerate(sample.fields, 1):
+						paths = [os.path.join(folder, field) for folder in sample.folders[1:]]
+						for thre in thresholds:
+							keys[(field, thre)] = manifest.key(paths, dict(params, Threshold=thre))
+							hit = manifest.get(name + '/' + field + '/' + str(thre), keys[(field, thre)])
+							if hit is not None:
+								columns = dict(hit[thre][0])
+								rows = columns.pop('_index')
+								table = pd.DataFrame(columns, index=rows)
+								table['field'] = np.full(len(table), c, dtype=table['field'].dtype) # the place of the field may have changed
+								tables[(field, thre)] = table
+
+				self.status('Starting '+name)
+				for field in sample.fields:
+					if self.checkpoint():
+						self.status('Analysis cancelled.')
+						return
+
+					### Average, align and find the peak candidates of one field, unless all its tables are cached ###
+					if any((field, thre) not in tables for thre in thresholds):
+						field_tic = time.perf_counter()
+						sample.candidates(field)
+						self.field_rates.append((time.perf_counter() - field_tic, unit_bytes[(name, field)]))
+
+					done += 1
+					remaining_bytes -= unit_bytes[(name, field)]
+					seconds, nbytes = np.sum(self.field_rates, axis=0) if self.field_rates else (0, 0)
+					eta = float(seconds/nbytes * remaining_bytes) if nbytes else None
+					self.events.put(('progress', (done, total, eta)))
 
-				sample.img_correction()
 				for thre in thresholds:
-					self.updateStatus('At threshold:' + str(thre))
-					data_file = pd.DataFrame()
-					sample.peak_location(thre)
-					result = sample.influx()
-					for i in result.values():
-						data_file = pd.concat([data_file, i]) 
-					data_file.to_csv(result_path+'/'+name+'_at_'+str(thre)+'.csv')
-					'''
-					plt.figure()
-					hist_plot = sns.distplot(data_file['influx'])
-					hist_plot.figure.savefig(result_path+'/'+name+'_at_'+str(thre)+'.png')
-					plt.close()
-					'''
-					if est == 0:
-						toc = time.time()
-						est_time = str(datetime.timedelta(seconds=(np.ceil((toc - tic + 15)*len(sample_names)*len(thresholds)))))
-						self.updateStatus('Estimated processing time: '+est_time)
-						est = 1
-
-					summa = pd.DataFrame({
-						'file': [name],
-						'threshold': [thre],
-						'influx': [round(data_file['influx'].mean(),2)],
-						'n': [len(data_file.index)]
-						})
-					self.summary = pd.concat([self.summary, summa])
-
-					self.updateStatus('Influx for '+name +' at ' + str(thre)+'(threshold):' + str(round(data_file['influx'].mean(),2))+'%')
-
-			else:
-				error_items = ', '.join(list(compress(items, np.subtract(1, sample.error_report['path']))))
-				self.updateStatus('Path error with ' + error_items + 'folder(s) in ' + name +'.\n'+name+' was skipped.')
-
-		self.summary.to_csv(result_path+'/summary.csv')
-		self.updateStatus('Done. Total time cost: '+ str(datetime.timedelta(seconds = (np.ceil(date.time()-tic)))))
+					self.status('At threshold:' + str(thre))
+					missing = [field for field in sample.fields if (field, thre) not in tables]
+					if missing:
+						sample.peak_location(thre, missing)
+						for field, table in sample.influx(missing).items():
+							tables[(field, thre)] = table
+							if manifest is not None:
+								error = sample.error_report['influx'][thre][field]
+								manifest.put(name + '/' + field + '/' + str(thre), keys[(field, thre)], {thre: (dict({'_index': table.index.values}, **{column: table[column].values for column in table.columns}), error)})
+					data_file = pd.concat([tables[(field, thre)] for field in sample.fields])
+					sink.write(name+'_at_'+str(thre), data_file, index=True)
+
+					summary_rows.append([name, thre, round(data_file['influx'].mean(),2), len(data_file.index)])
+
+					self.status('Influx for '+name +' at ' + str(thre)+'(threshold):' + str(round(data_file['influx'].mean(),2))+'%')
+
+				del sample # its images, candidates and photometry
+
+		finally:
+			if manifest is not None:
+				manifest.save(units)
+			summary = pd.DataFrame(summary_rows, columns=['file', 'threshold', 'influx', 'n'], index=[0]*len(summary_rows))
+			sink.write('summary', summary, index=True, summary=True)
+			sink.close()
+			self.events.put(('done', summary))
+
+		self.status('Done. Total time cost: '+ str(datetime.timedelta(seconds = (np.ceil(time.time()-tic)))))
 
 if __name__ == "__main__":
 
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic benchmark for the Calcium Influx Assay analysis
+
+Writes plates of Ionomycin/Sample/Blank tiff stacks with a known influx for every
+liposome, known stage shifts and shot noise, then times every step of local_tools
+and the whole main.py pipeline on them and checks the recovered influx against
+the ground truth.
+
+Usage:
+	python benchmark.py --sizes 256 512 1024 --frames 20 --fields 4
+	python benchmark.py --startup
+	python benchmark.py --seams
+
+Must work with local_tools.py and main.py in the same folder.
+"""
+
+import os
+import io
+import json
+import time
+import sys
+import shutil
+import argparse
+import subprocess
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+import tifffile as tiff
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+import local_tools
+import main
+
+
+def liposome_images(size, density, rng, max_shift=5, psf_sigma=1.0, background=500, amplitude=(1500, 4000), baseline=0.1):
+	"""
+	noise-free Ionomycin, Sample and Blank images of one field
+	Blank liposomes are at 'baseline' of their Ionomycin brightness and Sample ones at
+	baseline + influx/100*(1-baseline), so (Sample-Blank)/(Ionomycin-Blank) gives back the influx.
+	para: size - integer, images are size x size
+	para: density - float, liposomes per 10^4 pixels
+	para: rng - np.random.Generator
+	para: max_shift - integer, largest stage shift of Sample and Blank in pixels
+	return: images - list of 2D float array [Ionomycin, Sample, Blank]
+	return: truth - dict {x:, y:, influx:, sample_shift:, blank_shift:}
+	"""
+
+	pad = max_shift + 4*int(np.ceil(psf_sigma))
+	full = size + 2*pad
+	n_spots = rng.poisson(density*size*size/1e4)
+	xy = rng.uniform(pad, pad + size, (n_spots, 2))
+	brightness = rng.uniform(amplitude[0], amplitude[1], n_spots)
+	influx = rng.uniform(0, 100, n_spots)
+
+	rows, cols = np.clip(np.rint(xy).astype(int), 0, full-1).T
+	def render(weights):
+		image = np.zeros((full, full))
+		np.add.at(image, (rows, cols), weights)
+		return ndimage.gaussian_filter(image, psf_sigma)*2*np.pi*psf_sigma**2 + background
+
+	ionomycin = render(brightness)
+	blank = render(brightness*baseline)
+	sample = render(brightness*(baseline + influx/100*(1 - baseline)))
+
+	sample_shift = rng.integers(-max_shift, max_shift+1, 2)
+	blank_shift = rng.integers(-max_shift, max_shift+1, 2)
+	def crop(image, shift=(0, 0)):
+		return image[pad+shift[0]:pad+shift[0]+size, pad+shift[1]:pad+shift[1]+size]
+
+	truth = {
+		'x': (rows - pad).tolist(),
+		'y': (cols - pad).tolist(),
+		'influx': influx.tolist(),
+		'sample_shift': (-sample_shift).tolist(),
+		'blank_shift': (-blank_shift).tolist()
+	}
+	return [crop(ionomycin), crop(sample, sample_shift), crop(blank, blank_shift)], truth
+
+
+def generate_plate(path, n_samples=2, n_fields=3, size=512, frames=20, density=20, max_shift=5, noise=True, seed=0):
+	"""
+	write a plate in the layout main.py and the UI expect:
+		path/<sample>/{Ionomycin,Sample,Blank}/<field>.tif
+	and its ground truth as path/ground_truth.json
+	para: path - string
+	para: n_samples, n_fields - integer
+	para: size - integer, image size in pixels
+	para: frames - integer, frames per stack
+	para: density - float, liposomes per 10^4 pixels
+	para: max_shift - integer, largest stage shift in pixels
+	para: noise - bool, add Poisson shot noise to every frame
+	para: seed - integer
+	return: truth - dict {sample: {field: truth of liposome_images}}
+	"""
+
+	rng = np.random.default_rng(seed)
+	truth = {}
+	for s in range(n_samples):
+		sample = 'sample_' + str(s+1).zfill(2)
+		truth[sample] = {}
+		for f in range(n_fields):
+			field = 'field_' + str(f+1).zfill(3) + '.tif'
+			images, truth[sample][field] = liposome_images(size, density, rng, max_shift)
+			for folder, image in zip(['Ionomycin', 'Sample', 'Blank'], images):
+				os.makedirs(os.path.join(path, sample, folder), exist_ok=True)
+				stack = np.broadcast_to(image, (frames,) + image.shape)
+				stack = rng.poisson(stack) if noise else np.rint(stack)
+				tiff.imwrite(os.path.join(path, sample, folder, field), stack.astype(np.uint16))
+
+	with open(os.path.join(path, 'ground_truth.json'), 'w') as f:
+		json.dump(truth, f)
+	return truth
+
+
+def influx_accuracy(path, truth, size, max_distance=2, margin=30):
+	"""
+	compare the influx main.py recovered with the ground truth
+	para: path - string, plate folder with main.py results
+	para: truth - dict, as returned by generate_plate
+	para: size - integer, image size in pixels
+	para: max_distance - float, largest distance in pixels between a peak and its liposome
+	para: margin - integer, border of peak_locating, liposomes in it are not counted
+	return: accuracy - dict {recall:, median_error:, mean_error:}
+	"""
+
+	found, matched, errors = 0, 0, []
+	for sample, fields in truth.items():
+		results = pd.read_csv(os.path.join(path, 'results', 'raw', sample + '.csv'))
+		for c, field in enumerate(sorted(fields), 1):
+			spots = fields[field]
+			peaks = results[results['Field'] == c]
+			xy = np.column_stack((spots['x'], spots['y']))
+			inside = ((xy > margin + max_distance) & (xy < size - margin - max_distance)).all(axis=1)
+			found += inside.sum()
+			if len(peaks) == 0 or len(xy) == 0:
+				continue
+			distance, index = cKDTree(xy).query(peaks[['X', 'Y']].values)
+			close = distance <= max_distance
+			matched += np.unique(index[close & inside[index]]).size
+			recovered = peaks['Influx'].values[close]
+			expected = np.array(spots['influx'])[index[close]]
+			valid = ~np.isnan(recovered)
+			errors.append(np.abs(recovered[valid] - expected[valid]))
+
+	errors = np.concatenate(errors) if errors else np.array([])
+	return {
+		'recall': matched/found if found else float('nan'),
+		'median_error': float(np.median(errors)) if len(errors) else float('nan'),
+		'mean_error': float(np.mean(errors)) if len(errors) else float('nan')
+	}
+
+
+def timed(function, *args, repeat=3, **kwargs):
+	"""
+	para: function - callable
+	para: repeat - integer, the best of 'repeat' runs is reported
+	return: seconds - float
+	return: result - return value of the last run
+	"""
+
+	best = float('inf')
+	for _ in range(repeat):
+		tic = time.perf_counter()
+		result = function(*args, **kwargs)
+		best = min(best, time.perf_counter() - tic)
+	return best, result
+
+
+def benchmark_size(path, size, frames, n_samples, n_fields, density, workers, Holder):
+	"""
+	time every local_tools step and the whole pipeline on a synthetic plate of one image size
+	return: rows - list of dict {size:, stage:, seconds:, fields_per_s:, peaks_per_s:}
+	return: accuracy - dict, see influx_accuracy
+	"""
+
+	plate = os.path.join(path, 'plate_' + str(size))
+	truth = generate_plate(plate, n_samples, n_fields, size, frames, density)
+	sample = sorted(truth)[0]
+	field = sorted(truth[sample])[0]
+	threshold = int(str(Holder['Threshold']).split('/')[0])
+	radius = int(Holder['Radius'])
+
+	stacks = [os.path.join(plate, sample, folder, field) for folder in ['Ionomycin', 'Sample', 'Blank']]
+	t_average, images = timed(lambda: [local_tools.average_frame(stack) for stack in stacks])
+	t_align, aligned = timed(local_tools.img_alignment, *images)
+	images = [images[0], aligned[0], aligned[1]]
+	t_peaks, peaks = timed(local_tools.peak_locating, images[0], threshold)
+	t_photometry, inten = timed(local_tools.aperture_photometry, images, peaks, radius)
+	t_influx, _ = timed(local_tools.influx_kernel, inten[:, 0], inten[:, 1], inten[:, 2], Holder['High'], Holder['Low'])
+
+	H = dict(Holder, PATH=plate, Workers=workers)
+	with contextlib.redirect_stdout(io.StringIO()):
+		t_pipeline, _ = timed(main.run, plate, H, repeat=1)
+	n_peaks = sum(len(pd.read_csv(os.path.join(plate, 'results', 'raw', s + '.csv'))) for s in truth)
+	n_total = n_samples*n_fields
+
+	rows = []
+	for stage, seconds, fields, n in [
+		('average_frame x3', t_average, 1, len(peaks)),
+		('img_alignment', t_align, 1, len(peaks)),
+		('peak_locating', t_peaks, 1, len(peaks)),
+		('aperture_photometry', t_photometry, 1, len(peaks)),
+		('influx_kernel', t_influx, 1, len(peaks)),
+		('main.run', t_pipeline, n_total, n_peaks)]:
+		rows.append({
+			'size': size,
+			'stage': stage,
+			'seconds': seconds,
+			'fields_per_s': fields/seconds if seconds else float('inf'),
+			'peaks_per_s': n/seconds if seconds else float('inf')
+		})
+
+	return rows, influx_accuracy(plate, truth, size)
+
+
+# imports UI.py did at start-up before the analysis modules were deferred
+EAGER_IMPORTS = 'import numpy, pandas, scipy.ndimage, scipy.fft, tifffile, matplotlib.pyplot, seaborn'
+
+UI_STARTUP = """
+import sys, time
+tic = time.perf_counter()
+import UI
+imported = time.perf_counter() - tic
+try:
+	root = UI.Tk()
+except UI.TclError:
+	print(imported, 'nan')
+	sys.exit()
+UI.UserInterface(root)
+root.update()
+print(imported, time.perf_counter() - tic)
+root.destroy()
+"""
+
+
+def seam_check(size=512, tile_sizes=(37, 64, 100, 128), radii=(3, 8, 12, 20), seed=0):
+	"""
+	check that tiled fields give the peaks and influx of the whole field
+	The Ionomycin image holds liposomes, saturated disks (bright aggregates) wider than
+	the tile halo centred on the seams of every tile size, and flat maxima from coarsely
+	quantised smooth noise, all of which can be cut off at the edge of a tile.
+	para: size - integer, image size in pixels
+	para: tile_sizes - list of integer, Holder['TileSize'] values checked
+	para: radii - list of integer, aperture radii checked
+	para: seed - integer
+	return: rows - list of dict {radius:, tile_size:, tile_workers:, peaks:, tiled_peaks:, identical:}
+	"""
+
+	rng = np.random.default_rng(seed)
+	images, truth = liposome_images(size, 20, rng, max_shift=0)
+	plateaus = np.round(ndimage.gaussian_filter(rng.normal(0, 1, (size, size)), 4)*30)*100
+	ionomycin = images[0] + np.clip(plateaus, 0, None)
+	rows, cols = np.mgrid[:size, :size]
+	for n, tile_size in enumerate(tile_sizes):
+		seam = tile_size*(size//tile_size//2)
+		ionomycin[(rows - seam)**2 + (cols - size//(len(tile_sizes) + 1)*(n + 1))**2 <= (15 + 3*n)**2] = 65535
+	images = [np.minimum(np.round(image), 65535).astype(np.uint16) for image in [ionomycin, images[1], images[2]]]
+
+	def peaks(**settings):
+		Holder = dict(main.Holder, Threshold='100/400', RadiusSweep=4, **settings)
+		fieldResults = main.process_field('', '', '', 'seams', 1, Holder, frames=(images, True, None))
+		return {thre: fieldOutput for thre, (fieldOutput, fieldErr) in fieldResults.items()}
+
+	checks = []
+	for radius in radii:
+		whole = peaks(Radius=str(radius))
+		for tile_size in tile_sizes:
+			for tile_workers in [1, 3]:
+				tiled = peaks(Radius=str(radius), TileSize=tile_size, TileWorkers=tile_workers)
+				identical = all(np.array_equal(whole[thre][column], tiled[thre][column], equal_nan=True)
+					for thre in whole for column in whole[thre])
+				checks.append({
+					'radius': radius,
+					'tile_size': tile_size,
+					'tile_workers': tile_workers,
+					'peaks': sum(len(output['X']) for output in whole.values()),
+					'tiled_peaks': sum(len(output['X']) for output in tiled.values()),
+					'identical': identical
+				})
+	return checks
+
+
+def startup_time(repeat=3):
+	"""
+	time the UI takes to start, each run in a fresh interpreter
+	The window is only opened if there is a display; without one only the import of UI.py is timed.
+	The imports UI.py used to do before the window opened are timed as a reference.
+	para: repeat - integer, the best of 'repeat' runs is reported
+	return: rows - list of dict {stage:, seconds:}
+	"""
+
+	folder = os.path.dirname(os.path.abspath(__file__))
+	def best(code):
+		times = []
+		for _ in range(repeat):
+			output = subprocess.run([sys.executable, '-c', code], cwd=folder, capture_output=True, text=True)
+			if output.returncode != 0:
+				return None
+			times.append([float(value) for value in output.stdout.strip().splitlines()[-1].split()])
+		return np.min(times, axis=0)
+
+	rows = []
+	eager = best('import time; tic = time.perf_counter(); ' + EAGER_IMPORTS + '; print(time.perf_counter() - tic)')
+	if eager is not None:
+		rows.append({'stage': 'eager imports (before)', 'seconds': eager[0]})
+	imported, window = best(UI_STARTUP)
+	rows.append({'stage': 'import UI', 'seconds': imported})
+	rows.append({'stage': 'window shown', 'seconds': window})
+	return rows
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Benchmark the analysis on synthetic liposome plates.')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024], help='image sizes in pixels')
+	parser.add_argument('--frames', type=int, default=20, help='frames per tiff stack')
+	parser.add_argument('--samples', type=int, default=2, help='samples per plate')
+	parser.add_argument('--fields', type=int, default=3, help='fields of view per sample')
+	parser.add_argument('--density', type=float, default=20, help='liposomes per 10^4 pixels')
+	parser.add_argument('--workers', type=int, default=1, help='processes used by main.run')
+	parser.add_argument('--out', default=None, help='keep the plates and write benchmark.csv in this folder')
+	parser.add_argument('--startup', action='store_true', help='only time the start-up of the UI')
+	parser.add_argument('--seams', action='store_true', help='only check that tiled fields give the results of whole fields')
+	args = parser.parse_args()
+
+	if args.startup:
+		print(pd.DataFrame(startup_time()).to_string(index=False))
+		quit()
+
+	if args.seams:
+		checks = pd.DataFrame(seam_check())
+		print(checks.to_string(index=False))
+		if not checks['identical'].all():
+			sys.exit('Tiled fields differ from whole fields.')
+		quit()
+
+	path = args.out or tempfile.mkdtemp(prefix='calcium_benchmark_')
+	os.makedirs(path, exist_ok=True)
+
+	rows = []
+	try:
+		for size in args.sizes:
+			size_rows, accuracy = benchmark_size(path, size, args.frames, args.samples, args.fields, args.density, args.workers, main.Holder)
+			rows += size_rows
+			print('Size ' + str(size) + ': recall ' + str(round(accuracy['recall']*100, 1)) + '%, influx error median '
+				+ str(round(accuracy['median_error'], 2)) + ', mean ' + str(round(accuracy['mean_error'], 2)))
+
+		report = pd.DataFrame(rows)
+		print(report.to_string(index=False))
+		if args.out:
+			report.to_csv(os.path.join(path, 'benchmark.csv'), index=False)
+	finally:
+		if not args.out:
+			shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Header-only index of a plate for the Calcium Influx Assay analysis
+
+Scans the sample folders of a plate once and reads only the tiff headers
+(frame shape, dtype, number of frames, file size) of every Ionomycin, Sample
+and Blank stack, without decoding pixels. Fields whose three stacks are not all
+present, can not be read or do not match are reported before the run starts
+instead of failing halfway through it. The index is saved as
+'PLATE/.dataset_index.json' and only files whose size or modification time
+changed are read again on the next scan. The bytes of every field give the
+ETA of a run.
+
+Must work with main.py and UI.py in the same folder.
+"""
+
+import os
+import json
+import time
+import numpy as np
+import tifffile as tiff
+
+
+INDEX_VERSION = 2
+STACKS = ['Ionomycin', 'Sample', 'Blank']
+SKIPPED_FOLDERS = ['results', 'Results'] # output folders of main.py and UI.py
+
+
+def tiff_header(path):
+	"""
+	read the header of a stacked tiff file, no pixel is decoded
+	A file is truncated when its data would end past the end of the file, or when
+	pages of a compressed stack are missing, e.g. a copy which did not finish.
+	para: path - string
+	return: header - dict {size:, mtime:, shape:, dtype:, frames:, truncated:}, shape of one frame
+	"""
+
+	stat = os.stat(path)
+	with tiff.TiffFile(path) as tif:
+		series = tif.series[0]
+		shape = [int(n) for n in series.shape]
+		dtype = str(series.dtype)
+		frames = int(np.prod(shape[:-2])) if len(shape) > 2 else 1
+		if series.dataoffset is not None:
+			truncated = series.dataoffset + series.nbytes > stat.st_size
+		else:
+			pages = tif.pages
+			last = pages[len(pages) - 1]
+			end = max((offset + count for offset, count in zip(last.dataoffsets, last.databytecounts)), default=stat.st_size + 1)
+			truncated = len(pages) < frames or end > stat.st_size
+	return {
+		'size': stat.st_size,
+		'mtime': stat.st_mtime_ns,
+		'shape': shape[-2:],
+		'dtype': dtype,
+		'frames': frames,
+		'truncated': bool(truncated)
+	}
+
+
+def format_eta(seconds):
+	"""
+	para: seconds - float or None
+	return: eta - string 'h:mm:ss', '?' if unknown
+	"""
+
+	if seconds is None:
+		return '?'
+	seconds = int(np.ceil(seconds))
+	return str(seconds//3600) + ':' + str(seconds//60 % 60).zfill(2) + ':' + str(seconds % 60).zfill(2)
+
+
+class DatasetIndex:
+	"""
+	Validated (sample, field) manifest of a plate from the tiff headers.
+	"""
+
+	def __init__(self, mainPath):
+		"""
+		para: mainPath - string, plate folder
+		"""
+
+		self.mainPath = mainPath
+		self.index_path = os.path.join(mainPath, '.dataset_index.json')
+		self.files = {} # 'sample/stack/field': header
+		self.units = [] # {sample:, field:, bytes:, frames:, shape:}, valid fields in order
+		self.sample_list = [] # samples with an Ionomycin folder, in order, even without a valid field
+		self.problems = [] # {sample:, field:, reason:}
+
+	def sample_names(self):
+		"""
+		return: names - list of string, folders of the plate that may hold a sample, sorted
+		"""
+
+		return sorted(entry.name for entry in os.scandir(self.mainPath)
+			if entry.is_dir() and not entry.name.startswith('.') and entry.name not in SKIPPED_FOLDERS)
+
+	def load(self):
+		"""
+		headers of an earlier scan, if any
+		return: files - dict {'sample/stack/field': header}
+		"""
+
+		try:
+			with open(self.index_path) as f:
+				index = json.load(f)
+			if index.get('version') == INDEX_VERSION:
+				return index['files']
+		except (OSError, ValueError, KeyError):
+			pass
+		return {}
+
+	def save(self):
+		"""
+		write the index as 'PLATE/.dataset_index.json'
+		"""
+
+		tmp_path = self.index_path + '.' + str(os.getpid()) + '.tmp'
+		try:
+			with open(tmp_path, 'w') as f:
+				json.dump({'version': INDEX_VERSION, 'files': self.files, 'units': self.units, 'problems': self.problems}, f, indent=1)
+			os.replace(tmp_path, self.index_path)
+		except OSError:
+			pass # a read-only plate is indexed again next time
+
+	def scan(self, save=True):
+		"""
+		index every sample of the plate, reusing the headers of unchanged files
+		para: save - bool, write the index for the next scan
+		return: self
+		"""
+
+		known = self.load()
+		self.files, self.units, self.problems, self.sample_list = {}, [], [], []
+
+		for sample in self.sample_names():
+			folders = [os.path.join(self.mainPath, sample, stack) for stack in STACKS]
+			if not os.path.isdir(folders[0]):
+				self.problems.append({'sample': sample, 'field': '', 'reason': 'no Ionomycin folder'})
+				continue
+			self.sample_list.append(sample)
+
+			names = [set(name for name in os.listdir(folder) if name.endswith('.tif')) if os.path.isdir(folder) else set() for folder in folders]
+			for field in sorted(names[0] | names[1] | names[2]):
+				missing = [stack for stack, found in zip(STACKS, names) if field not in found]
+				if missing:
+					self.problems.append({'sample': sample, 'field': field, 'reason': 'no ' + '/'.join(missing) + ' file'})
+					continue
+
+				headers = []
+				for stack, folder in zip(STACKS, folders):
+					key = sample + '/' + stack + '/' + field
+					path = os.path.join(folder, field)
+					header = known.get(key)
+					try:
+						stat = os.stat(path)
+						if header is None or header['size'] != stat.st_size or header['mtime'] != stat.st_mtime_ns:
+							header = tiff_header(path)
+					except Exception as e:
+						header = {'error': repr(e)}
+					self.files[key] = header
+					headers.append(header)
+
+				reason = self.validate(headers)
+				if reason:
+					self.problems.append({'sample': sample, 'field': field, 'reason': reason})
+					continue
+				self.units.append({
+					'sample': sample,
+					'field': field,
+					'bytes': sum(header['size'] for header in headers),
+					'frames': sum(header['frames'] for header in headers),
+					'shape': headers[0]['shape']
+				})
+
+		if save:
+			self.save()
+		return self
+
+	@staticmethod
+	def validate(headers):
+		"""
+		para: headers - list of the Ionomycin, Sample and Blank headers of a field
+		return: reason - string, why the field can not be analysed, '' if it can
+		"""
+
+		for stack, header in zip(STACKS, headers):
+			if 'error' in header:
+				return stack + ' file can not be read: ' + header['error']
+			if header['frames'] == 0:
+				return stack + ' file has no frame'
+			if header['truncated']:
+				return stack + ' file truncated'
+		if any(header['shape'] != headers[0]['shape'] for header in headers):
+			return 'frame sizes differ: ' + ', '.join('x'.join(str(n) for n in header['shape']) for header in headers)
+		return ''
+
+	def fields(self, sample):
+		"""
+		para: sample - string
+		return: fields - list of string, valid fields of the sample in order
+		"""
+
+		return [unit['field'] for unit in self.units if unit['sample'] == sample]
+
+	def samples(self):
+		"""
+		return: samples - list of (sample, ionomycinPath, samplePath, blankPath, fieldNames), as main.run uses them
+			Samples with an Ionomycin folder but no valid field are kept with no field, so they are reported.
+		"""
+
+		return [(sample, *[self.mainPath + '/' + sample + '/' + stack + '/' for stack in STACKS], self.fields(sample))
+			for sample in self.sample_list]
+
+	def unit_bytes(self):
+		"""
+		return: nbytes - dict {(sample, field): bytes of its three stacks}
+		"""
+
+		return {(unit['sample'], unit['field']): unit['bytes'] for unit in self.units}
+
+
+class Progress:
+	"""
+	ETA of a run from the bytes of the fields done and to do, so that large
+	fields late in a plate do not make the estimate too optimistic.
+	"""
+
+	def __init__(self, total_bytes, total_fields):
+		"""
+		para: total_bytes - integer, bytes of all the fields to analyse
+		para: total_fields - integer
+		"""
+
+		self.total_bytes = total_bytes
+		self.total_fields = total_fields
+		self.done_bytes = 0
+		self.done_fields = 0
+		self.start = time.perf_counter()
+
+	def update(self, nbytes):
+		"""
+		para: nbytes - integer, bytes of the field just finished
+		"""
+
+		self.done_bytes += nbytes
+		self.done_fields += 1
+
+	def eta(self):
+		"""
+		return: seconds - float, None before the first field is done
+		"""
+
+		if self.done_bytes == 0:
+			return None
+		elapsed = time.perf_counter() - self.start
+		return elapsed/self.done_bytes*(self.total_bytes - self.done_bytes)
+
+	def __str__(self):
+		return str(self.done_fields) + '/' + str(self.total_fields) + ' fields, ETA ' + format_eta(self.eta())
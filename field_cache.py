@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Caches for re-analysis of a plate
+
+FieldManifest remembers the results of every field of view together with a key
+made from its input files and the analysis parameters, so that a later run only
+recomputes the fields whose inputs or parameters changed.
+
+FrameCache keeps the averaged and aligned images of every field, which do not
+depend on threshold or radius, so that parameter tuning does not decode the
+raw tiff stacks again.
+
+Must work with main.py in the same folder.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+CACHE_VERSION = 1 # bump when a change in the analysis makes cached results invalid
+
+
+def file_signature(path, hash_files=False):
+	"""
+	signature of an input file, (size, mtime) or the sha1 of its content
+	para: path - string
+	para: hash_files - bool
+	return: signature - list
+	"""
+
+	stat = os.stat(path)
+	if not hash_files:
+		return [stat.st_size, stat.st_mtime_ns]
+
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			sha1.update(block)
+	return [stat.st_size, sha1.hexdigest()]
+
+
+def cache_key(paths, params, hash_files=False):
+	"""
+	para: paths - list of string, input files
+	para: params - dict, parameters the cached data depends on
+	para: hash_files - bool
+	return: key - string, sha1 of the file signatures and the parameters
+	"""
+
+	description = {
+		'version': CACHE_VERSION,
+		'files': [[os.path.basename(path), file_signature(path, hash_files)] for path in paths],
+		'params': params
+	}
+	return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def save_field_results(path, fieldResults):
+	"""
+	write the results of a field as an npz file, replacing 'path' atomically
+	para: path - string, ending with '.npz'
+	para: fieldResults - dict {threshold: (dict of 1D array, integer)}, as main.process_field returns
+	"""
+
+	arrays = {}
+	for thre, (columns, error) in fieldResults.items():
+		for column, values in columns.items():
+			arrays[str(thre) + '/' + column] = values
+		arrays[str(thre) + '/_error'] = np.array(error)
+
+	tmp_path = path[:-len('.npz')] + '.' + str(os.getpid()) + '.tmp.npz'
+	np.savez(tmp_path, **arrays)
+	os.replace(tmp_path, path)
+
+
+def load_field_results(path):
+	"""
+	para: path - string, written by save_field_results
+	return: fieldResults - dict {threshold: (dict of 1D array, integer)}
+	"""
+
+	fieldResults = {}
+	with np.load(path, allow_pickle=False) as data:
+		for name in data.files:
+			thre, column = name.split('/', 1)
+			thre = int(thre)
+			if thre not in fieldResults:
+				fieldResults[thre] = ({}, 0)
+			if column == '_error':
+				fieldResults[thre] = (fieldResults[thre][0], int(data[name]))
+			else:
+				fieldResults[thre][0][column] = data[name]
+	return fieldResults
+
+
+class FieldManifest:
+	"""
+	Manifest of cached field results, kept as 'cachePath/manifest.json'.
+	Results are stored content-addressed as 'cachePath/<key>.npz', where the key
+	is the sha1 of the input file signatures and the parameters.
+	"""
+
+	def __init__(self, cachePath, hash_files=False):
+		"""
+		para: cachePath - string
+		para: hash_files - bool, identify inputs by content hash instead of size and mtime
+		"""
+
+		self.cachePath = cachePath
+		self.hash_files = hash_files
+		self.manifest_path = os.path.join(cachePath, 'manifest.json')
+		os.makedirs(cachePath, exist_ok=True)
+
+		self.entries = {}
+		if os.path.isfile(self.manifest_path):
+			try:
+				with open(self.manifest_path) as f:
+					manifest = json.load(f)
+				if manifest.get('version') == CACHE_VERSION:
+					self.entries = manifest['fields']
+			except (ValueError, KeyError):
+				self.entries = {}
+
+	def key(self, paths, params):
+		"""
+		para: paths - list of string, input files of the field
+		para: params - dict, parameters the result depends on
+		return: key - string
+		"""
+
+		return cache_key(paths, params, self.hash_files)
+
+	def get(self, unit, key):
+		"""
+		cached result of a field, if its key did not change
+		para: unit - string, identifier of the field, e.g. 'sample/field.tif'
+		para: key - string
+		return: fieldResults - dict {threshold: (dict of 1D array, integer)} or None
+		"""
+
+		if self.entries.get(unit) != key:
+			return None
+		path = os.path.join(self.cachePath, key + '.npz')
+		if not os.path.isfile(path):
+			return None
+
+		return load_field_results(path)
+
+	def put(self, unit, key, fieldResults):
+		"""
+		para: unit - string
+		para: key - string
+		para: fieldResults - dict {threshold: (dict of 1D array, integer)}
+		"""
+
+		save_field_results(os.path.join(self.cachePath, key + '.npz'), fieldResults)
+		self.entries[unit] = key
+
+	def save(self, units=None):
+		"""
+		write the manifest and delete cached results no field refers to any more
+		para: units - list of string, fields of the plate, others are forgotten
+		"""
+
+		if units is not None:
+			self.entries = {unit: self.entries[unit] for unit in units if unit in self.entries}
+
+		tmp_path = self.manifest_path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump({'version': CACHE_VERSION, 'fields': self.entries}, f, indent=1, sort_keys=True)
+		os.replace(tmp_path, self.manifest_path)
+
+		keep = {key + '.npz' for key in self.entries.values()}
+		for name in os.listdir(self.cachePath):
+			if name.endswith('.npz') and name not in keep:
+				os.remove(os.path.join(self.cachePath, name))
+
+
+class FrameCache:
+	"""
+	On-disk store of the averaged and aligned Ionomycin, Sample and Blank images.
+	Every field is one (3, rows, cols) .npy file named by its key, loaded memory-mapped.
+	When the store grows past 'max_bytes' the least recently used files are evicted.
+	"""
+
+	def __init__(self, cachePath, max_bytes=2*1024**3, hash_files=False):
+		"""
+		para: cachePath - string
+		para: max_bytes - integer, size limit of the store
+		para: hash_files - bool, identify inputs by content hash instead of size and mtime
+		"""
+
+		self.cachePath = cachePath
+		self.max_bytes = max_bytes
+		self.hash_files = hash_files
+
+	def key(self, paths, params):
+		"""
+		para: paths - list of string, Ionomycin, Sample and Blank files of the field
+		para: params - dict, averaging and alignment parameters
+		return: key - string
+		"""
+
+		return cache_key(paths, params, self.hash_files)
+
+	def load(self, key):
+		"""
+		para: key - string
+		return: frames - memory-mapped 3D array [Ionomycin, Sample, Blank] or None if not cached
+		"""
+
+		path = os.path.join(self.cachePath, key + '.npy')
+		try:
+			frames = np.load(path, mmap_mode='r')
+			os.utime(path) # mark as recently used
+		except (FileNotFoundError, ValueError):
+			return None
+		return frames
+
+	def store(self, key, frames):
+		"""
+		para: key - string
+		para: frames - 3D array [Ionomycin, Sample, Blank]
+		"""
+
+		os.makedirs(self.cachePath, exist_ok=True)
+		tmp_path = os.path.join(self.cachePath, key + '.' + str(os.getpid()) + '.tmp')
+		with open(tmp_path, 'wb') as f:
+			np.save(f, np.ascontiguousarray(frames))
+		os.replace(tmp_path, os.path.join(self.cachePath, key + '.npy'))
+		self.evict()
+
+	def evict(self):
+		"""
+		delete the least recently used files until the store fits in max_bytes
+		Files which can not be removed yet, e.g. mapped by a run on Windows, are skipped.
+		"""
+
+		files = []
+		for name in os.listdir(self.cachePath):
+			if not name.endswith('.npy'):
+				continue
+			try:
+				stat = os.stat(os.path.join(self.cachePath, name))
+			except FileNotFoundError:
+				continue
+			files.append((stat.st_mtime_ns, stat.st_size, name))
+
+		total = sum(size for _, size, _ in files)
+		for _, size, name in sorted(files):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(os.path.join(self.cachePath, name))
+			except FileNotFoundError:
+				pass
+			except OSError:
+				continue # still memory-mapped (Windows), left for the next eviction
+			total -= size
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+File-based job queue to share the analysis of a plate between several machines
+
+All state lives in 'PLATE/results/.queue' on the shared filesystem:
+	manifest.json     settings of the run and the (sample, field) units, in order
+	todo/<unit>.json  units nobody works on
+	claimed/<unit>.<worker>.json
+	                  units being analysed, a claim is taken by renaming the todo
+	                  file (atomic), and its modification time is the heartbeat
+	done/<unit>.npz   results of the finished units
+	failed/<unit>.json
+	                  units whose analysis raised, with the error; moving one back
+	                  into todo runs it again
+
+A claim whose heartbeat is older than the timeout belongs to a crashed worker
+and is put back into todo by whichever worker notices it first. A field which
+raises (e.g. a corrupt tiff) is failed instead, so it is not retried forever,
+and merge reports it as skipped in the summaries.
+
+Usage:
+	python job_queue.py init PLATE_FOLDER        (once, on any machine)
+	python job_queue.py work PLATE_FOLDER        (on every machine, as many as wanted)
+	python job_queue.py status PLATE_FOLDER
+	python job_queue.py merge PLATE_FOLDER       (writes summary.csv and raw/ as main.py does)
+
+Must work with main.py and field_cache.py in the same folder.
+"""
+
+import os
+import json
+import time
+import socket
+import shutil
+import argparse
+import threading
+
+import field_cache
+import main
+
+
+QUEUE_VERSION = 2
+
+
+class JobQueue:
+	"""
+	Queue of the fields of one plate, see the module docstring for the layout.
+	"""
+
+	def __init__(self, mainPath):
+		"""
+		para: mainPath - string, plate folder as mounted on this machine
+		"""
+
+		self.mainPath = mainPath
+		self.queuePath = os.path.join(mainPath, 'results', '.queue')
+		self.manifest_path = os.path.join(self.queuePath, 'manifest.json')
+		self.folders = {state: os.path.join(self.queuePath, state) for state in ['todo', 'claimed', 'done', 'failed']}
+
+	def init(self, Holder, force=False):
+		"""
+		write the manifest and queue every field of the plate
+		para: Holder - dict of settings every worker will use
+		para: force - bool, replace an existing queue and its results
+		"""
+
+		if os.path.isfile(self.manifest_path) and not force:
+			raise FileExistsError('A queue already exists in ' + self.queuePath + ', use force to replace it.')
+		shutil.rmtree(self.queuePath, ignore_errors=True)
+		for folder in self.folders.values():
+			os.makedirs(folder)
+
+		units = []
+		samples = main.find_samples(self.mainPath)
+		for (sample, ionomycinPath, samplePath, blankPath, fieldNames) in samples:
+			for c, field in enumerate(fieldNames, 1):
+				units.append({'id': str(len(units)).zfill(6), 'sample': sample, 'field': field, 'c': c})
+
+		manifest = {
+			'version': QUEUE_VERSION,
+			'settings': {name: value for name, value in Holder.items() if name != 'PATH'},
+			'samples': [sample[0] for sample in samples],
+			'units': units
+		}
+		tmp_path = self.manifest_path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(manifest, f, indent=1)
+
+		for unit in units:
+			with open(os.path.join(self.folders['todo'], unit['id'] + '.json'), 'w') as f:
+				json.dump(unit, f)
+		os.replace(tmp_path, self.manifest_path)
+
+	def manifest(self):
+		"""
+		return: manifest - dict {version:, settings:, samples:, units:}
+		"""
+
+		with open(self.manifest_path) as f:
+			manifest = json.load(f)
+		if manifest.get('version') != QUEUE_VERSION:
+			raise ValueError('Queue in ' + self.queuePath + ' was made by another version, initialise it again.')
+		return manifest
+
+	def holder(self):
+		"""
+		return: Holder - dict of settings of the queue, with PATH of this machine
+		"""
+
+		return dict(self.manifest()['settings'], PATH=self.mainPath)
+
+	def done_path(self, unit_id):
+		return os.path.join(self.folders['done'], unit_id + '.npz')
+
+	def failed_path(self, unit_id):
+		return os.path.join(self.folders['failed'], unit_id + '.json')
+
+	def status(self):
+		"""
+		return: counts - dict {todo:, claimed:, done:, failed:}
+		"""
+
+		return {state: len([name for name in os.listdir(folder) if not name.endswith(('.tmp.npz', '.tmp'))])
+			for state, folder in self.folders.items()}
+
+	def claim(self, worker):
+		"""
+		take the first unit nobody works on
+		para: worker - string, name of the worker
+		return: (unit, claim_path) - dict and string, or (None, None) if there is nothing to do
+		"""
+
+		for name in sorted(os.listdir(self.folders['todo'])):
+			unit_id = name.split('.')[0]
+			claim_path = os.path.join(self.folders['claimed'], unit_id + '.' + worker + '.json')
+			try:
+				os.rename(os.path.join(self.folders['todo'], name), claim_path)
+			except FileNotFoundError:
+				continue # claimed by another worker in the meantime
+
+			if os.path.isfile(self.done_path(unit_id)) or os.path.isfile(self.failed_path(unit_id)):
+				# recovered from a worker which was only slow, and has finished it since
+				os.remove(claim_path)
+				continue
+			os.utime(claim_path)
+			with open(claim_path) as f:
+				return json.load(f), claim_path
+
+		return None, None
+
+	def recover(self, timeout):
+		"""
+		put the units of workers whose heartbeat stopped back into todo
+		para: timeout - float, seconds without heartbeat after which a worker is taken as crashed
+		return: recovered - list of string, unit ids
+		"""
+
+		recovered = []
+		now = time.time()
+		for name in os.listdir(self.folders['claimed']):
+			claim_path = os.path.join(self.folders['claimed'], name)
+			try:
+				if now - os.path.getmtime(claim_path) < timeout:
+					continue
+				unit_id = name.split('.')[0]
+				os.rename(claim_path, os.path.join(self.folders['todo'], unit_id + '.json'))
+				recovered.append(unit_id)
+			except FileNotFoundError:
+				continue # finished or recovered by another worker
+		return recovered
+
+	def work(self, worker=None, heartbeat=30, timeout=300, poll=10):
+		"""
+		analyse units until the queue is empty
+		Workers wait while other workers hold claims, so the units of a worker which
+		crashes are still picked up once its heartbeat is older than 'timeout'.
+		para: worker - string, name of this worker, '<host>-<pid>' by default
+		para: heartbeat - float, seconds between heartbeats of the claim being analysed
+		para: timeout - float, see recover, must be well above 'heartbeat'
+		para: poll - float, seconds between looks at the queue while others hold every claim
+		return: n_units - integer, number of units analysed by this worker
+		"""
+
+		worker = worker or socket.gethostname() + '-' + str(os.getpid())
+		Holder = self.holder()
+		frameCache = None
+		if Holder.get('FrameCache', False):
+			frameCache = field_cache.FrameCache(self.mainPath + '/.frame_cache', int(Holder.get('FrameCacheSize', 2)*1024**3), Holder.get('HashInputs', False))
+
+		n_units = 0
+		while True:
+			for unit_id in self.recover(timeout):
+				print('Recovered ' + unit_id + ' from a stopped worker.')
+
+			unit, claim_path = self.claim(worker)
+			if unit is None:
+				if not os.listdir(self.folders['claimed']):
+					break
+				time.sleep(poll)
+				continue
+
+			### Keep the claim alive while the field is analysed ###
+			stop = threading.Event()
+			def beat():
+				while not stop.wait(heartbeat):
+					try:
+						os.utime(claim_path)
+					except FileNotFoundError:
+						return
+			beating = threading.Thread(target=beat, daemon=True)
+			beating.start()
+
+			try:
+				print(worker + ' running ' + unit['sample'] + '/' + unit['field'])
+				folders = [self.mainPath + '/' + unit['sample'] + '/' + stack + '/' for stack in ['Ionomycin', 'Sample', 'Blank']]
+				fieldResults = main.process_field(*folders, unit['field'], unit['c'], Holder, frameCache)
+				field_cache.save_field_results(self.done_path(unit['id']), fieldResults)
+			except Exception as e:
+				print(worker + ' failed on ' + unit['sample'] + '/' + unit['field'] + ': ' + repr(e))
+				self.fail(unit, repr(e))
+			finally:
+				stop.set()
+				beating.join()
+
+			try:
+				os.remove(claim_path)
+			except FileNotFoundError:
+				pass # recovered by another worker, which will find the result done
+			n_units += 1
+
+		return n_units
+
+	def fail(self, unit, error):
+		"""
+		mark a unit as failed, it is not put back into todo
+		para: unit - dict, as claimed
+		para: error - string
+		"""
+
+		path = self.failed_path(unit['id'])
+		with open(path + '.tmp', 'w') as f:
+			json.dump(dict(unit, error=error), f)
+		os.replace(path + '.tmp', path)
+
+	def failures(self):
+		"""
+		return: failed - dict {unit id: error}
+		"""
+
+		failed = {}
+		for name in os.listdir(self.folders['failed']):
+			if name.endswith('.json'):
+				with open(os.path.join(self.folders['failed'], name)) as f:
+					failed[name.split('.')[0]] = json.load(f)['error']
+		return failed
+
+	def merge(self):
+		"""
+		write 'results/summary.csv' and 'results/raw/' from the finished units, as main.run does
+		Failed units have no peak and their error in the '% Error' column of the field summary.
+		return: failed - dict {unit id: error}
+		"""
+
+		manifest = self.manifest()
+		Holder = dict(manifest['settings'], PATH=self.mainPath)
+		failed = self.failures()
+		missing = [unit['id'] for unit in manifest['units'] if unit['id'] not in failed and not os.path.isfile(self.done_path(unit['id']))]
+		if missing:
+			raise RuntimeError(str(len(missing)) + ' of ' + str(len(manifest['units'])) + ' fields are not finished yet.')
+
+		### Samples and their fields in the order of the manifest, samples without a valid field included ###
+		samples = [(sample, None, None, None, [unit['field'] for unit in manifest['units'] if unit['sample'] == sample])
+			for sample in manifest['samples']]
+		results = (main.skipped_field(Holder, 'analysis failed: ' + failed[unit['id']]) if unit['id'] in failed
+			else field_cache.load_field_results(self.done_path(unit['id'])) for unit in manifest['units'])
+
+		sinks = main.open_sinks(self.mainPath, Holder)
+		try:
+			main.write_samples(samples, results, sinks, Holder)
+		finally:
+			for sink in sinks.values():
+				sink.close()
+		return failed
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Share the analysis of a plate between several machines.')
+	parser.add_argument('command', choices=['init', 'work', 'status', 'merge'])
+	parser.add_argument('path', nargs='?', default=main.Holder['PATH'], help='plate folder')
+	parser.add_argument('--force', action='store_true', help='init: replace an existing queue')
+	parser.add_argument('--worker', default=None, help='work: name of this worker')
+	parser.add_argument('--heartbeat', type=float, default=30, help='work: seconds between heartbeats')
+	parser.add_argument('--timeout', type=float, default=300, help='work: seconds after which a silent worker is taken as crashed')
+	args = parser.parse_args()
+
+	if not os.path.isdir(args.path):
+		print('Data folder does not exist. Exit.')
+		quit()
+
+	queue = JobQueue(args.path)
+	if args.command == 'init':
+		queue.init(dict(main.Holder, PATH=args.path), args.force)
+		print(str(queue.status()['todo']) + ' fields queued.')
+	elif args.command == 'work':
+		print(str(queue.work(args.worker, args.heartbeat, args.timeout)) + ' fields analysed.')
+	elif args.command == 'status':
+		print(queue.status())
+	else:
+		failed = queue.merge()
+		print('Results written to ' + os.path.join(args.path, 'results'))
+		if failed:
+			print(str(len(failed)) + ' fields failed and are skipped: ' + ', '.join(sorted(failed)))
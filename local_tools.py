@@ -12,15 +12,15 @@ Copyright © 2018-2019 Zengjie Xia. All rights reserved.
 Version: 2.0
 """
 
-import cv2
 import os
 import tifffile as tiff
-from scipy.ndimage import filters
 from scipy import ndimage
+from scipy import fft
+from scipy.spatial import cKDTree
 import pandas as pd
 import numpy as np
-import math as ms
 import time
+import profiling
 
 
 def extract_filename(path):
@@ -39,90 +39,642 @@ def extract_filename(path):
 	return filenames
 
 
-def average_frame(path):
+def frame_chunks(path, chunk_size=16, profiler=None):
 	"""
-	input 'path' for stacked tiff file and the 'number of images' contained
-	separate individual images from a tiff stack.
+	Stream the frames of a stacked tiff file in chunks.
+	The stack is read through a memory map (or page by page if it can not be
+	memory-mapped, e.g. compressed files), so at most 'chunk_size' frames are
+	held in memory at any time.
 	para: path - string
+	para: chunk_size - integer, number of memory-mapped frames per chunk
+	para: profiler - profiling.StageProfiler or None, times 'tiff_read'
+	return: generator of 3D array (frames, rows, cols)
+	"""
+
+	with tiff.TiffFile(path) as tif:
+		stack = None
+		if tif.series[0].dataoffset is not None:
+			# contiguous, uncompressed data can be mapped straight from the file
+			stack = tif.asarray(out='memmap')
+
+		if stack is not None:
+			if stack.ndim == 2:
+				stack = stack[np.newaxis]
+			for start in range(0, stack.shape[0], chunk_size):
+				with profiling.stage(profiler, 'tiff_read'):
+					frames = stack[start:start+chunk_size]
+					if profiler is not None:
+						frames = np.array(frames) # read now, so reading is timed apart from averaging
+				yield frames
+			del stack, frames
+		else:
+			pages = tif.pages
+			for start in range(0, len(pages), chunk_size):
+				with profiling.stage(profiler, 'tiff_read'):
+					frames = np.stack([pages[i].asarray() for i in range(start, min(start + chunk_size, len(pages)))])
+				yield frames
+
+
+def average_frame(path, dtype='uint16', chunk_size=16, profiler=None):
+	"""
+	input 'path' for stacked tiff file and average all the frames in the stack.
+	The stack is streamed with frame_chunks, so only one float64 accumulator
+	and at most 'chunk_size' frames are held in memory at any time.
+	para: path - string
+	para: dtype - output data type, 'uint16' (truncated as before) or 'float32'/'float64'
+	para: chunk_size - integer, number of memory-mapped frames summed at once
+	para: profiler - profiling.StageProfiler or None, times 'tiff_read' and 'averaging'
 	return: ave_img - 2D array
 	"""
 
-	ori_img = tiff.imread(path)
-	ave_img = np.mean(ori_img, axis=0)
-	ave_img = ave_img.astype('uint16')
+	n_frames = 0
+	accumulator = None
+	for frames in frame_chunks(path, chunk_size, profiler):
+		with profiling.stage(profiler, 'averaging'):
+			if accumulator is None:
+				accumulator = np.zeros(frames.shape[1:], dtype=np.float64)
+			accumulator += frames.sum(axis=0, dtype=np.float64)
+			n_frames += frames.shape[0]
+
+	with profiling.stage(profiler, 'averaging'):
+		accumulator /= n_frames
+		ave_img = accumulator.astype(dtype)
 
 	return ave_img
 
 
-def img_alignment(Ionomycin, Sample, Blank):
+def drift_corrected_average(path, dtype='uint16', chunk_size=16, subpixel=False, window=None, max_drift=None, profiler=None):
+	"""
+	Average the frames of a stacked tiff file after registering every frame to a
+	running reference, so stage drift during the stack does not blur the image.
+	The frames of a chunk are registered together with one batched FFT against
+	the mean of the frames corrected so far, then shifted and accumulated.
+	para: path - string
+	para: dtype - output data type, as average_frame
+	para: chunk_size - integer, number of frames registered at once
+	para: subpixel - bool, see ImageRegistration
+	para: window - integer, see ImageRegistration, a central window is enough for the small drift within a stack
+	para: max_drift - integer, largest drift searched for in pixels (None for any), keeps dim stacks from registering to noise
+	para: profiler - profiling.StageProfiler or None, times 'tiff_read' and 'drift_correction'
+	return: ave_img - 2D array
+	return: drift - 2D float64 array (frames, 2), offset (dx, dy) applied to every frame
+	"""
+
+	n_frames = 0
+	accumulator = None
+	drift = []
+	for frames in frame_chunks(path, chunk_size, profiler):
+		with profiling.stage(profiler, 'drift_correction'):
+			if accumulator is None:
+				# the first frame is the reference of the first chunk
+				accumulator = np.zeros(frames.shape[1:], dtype=np.float64)
+				registration = ImageRegistration(frames[0], subpixel=subpixel, window=window, max_shift=max_drift)
+			else:
+				registration = ImageRegistration(accumulator/n_frames, subpixel=subpixel, window=window, max_shift=max_drift)
+			offsets = registration.offsets(frames)
+			for frame, offset in zip(frames, offsets):
+				accumulator += shift_image(frame.astype(np.float64), offset)
+			drift.append(offsets)
+			n_frames += frames.shape[0]
+
+	with profiling.stage(profiler, 'drift_correction'):
+		accumulator /= n_frames
+		ave_img = accumulator.astype(dtype)
+
+	return ave_img, np.concatenate(drift).reshape(-1, 2)
+
+
+def sample_frames(path, n_frames=3):
+	"""
+	a few frames spread evenly over a stacked tiff file, without reading the rest of it
+	para: path - string
+	para: n_frames - integer
+	return: frames - 3D array (frames, rows, cols) with the dtype of the file
+	"""
+
+	with tiff.TiffFile(path) as tif:
+		pages = tif.pages
+		index = np.unique(np.linspace(0, len(pages) - 1, n_frames).round().astype(int))
+		return np.stack([pages[int(i)].asarray() for i in index])
+
+
+def field_qc(path, threshold, n_frames=3):
+	"""
+	Quick quality metrics of a field from a few frames of its stack, to find fields
+	not worth the full analysis before their stacks are read.
+	focus - variance of the Laplacian over the squared mean, low when out of focus
+	saturation - fraction of pixels at the largest value of the dtype in any sampled frame
+	density - local maxima with a 3x3 contrast above 'threshold' per 10^4 pixels
+	para: path - string, normally the Ionomycin stack
+	para: threshold - integer, peak threshold of the analysis
+	para: n_frames - integer, number of frames sampled
+	return: metrics - dict {focus:, saturation:, density:}
+	"""
+
+	frames = sample_frames(path, n_frames)
+	saturation = float('nan')
+	if np.issubdtype(frames.dtype, np.integer):
+		saturation = float((frames == np.iinfo(frames.dtype).max).any(axis=0).mean())
+
+	image = frames.mean(axis=0)
+	mean = image.mean()
+	focus = float(ndimage.laplace(image).var()/mean**2) if mean > 0 else 0.0
+
+	data_max = ndimage.maximum_filter(image, 3)
+	maxima = (image == data_max) & (data_max - ndimage.minimum_filter(image, 3) > threshold)
+	density = float(maxima.sum()/image.size*1e4)
+
+	return {'focus': focus, 'saturation': saturation, 'density': density}
+
+
+def shift_image(image, offset):
+	"""
+	translate an image by 'offset' pixels, uncovered pixels are filled with 0
+	integer offsets are applied by array slicing, fractional ones by linear interpolation
+	para: image - 2D array
+	para: offset - tuple (dx, dy) in (row, column) order
+	return: shifted - 2D array with the same shape and dtype as image
+	"""
+
+	dx, dy = offset
+	if dx != int(dx) or dy != int(dy):
+		return ndimage.shift(image, (dx, dy), order=1, mode='constant', cval=0)
+
+	dx, dy = int(dx), int(dy)
+	shifted = np.zeros_like(image)
+	rows, cols = image.shape
+	if abs(dx) >= rows or abs(dy) >= cols:
+		return shifted
+	shifted[max(dx, 0):rows+min(dx, 0), max(dy, 0):cols+min(dy, 0)] = \
+		image[max(-dx, 0):rows-max(dx, 0), max(-dy, 0):cols-max(dy, 0)]
+
+	return shifted
+
+
+class ImageRegistration:
+	"""
+	Image registration based on cross-correlation against a fixed reference image.
+	The spectrum of the reference (normally the Ionomycin image) is computed once
+	and reused for every image aligned to it.
+	On large frames the offset can be estimated on a central window only, which
+	works as long as the shifts are small compared to the window.
+	"""
+
+	def __init__(self, reference, workers=-1, subpixel=False, window=None, max_shift=None):
+		"""
+		para: reference - 2D array
+		para: workers - integer, threads used by the FFTs (-1 for all cores)
+		para: subpixel - bool, refine the offset with a parabolic fit around the correlation peak
+		para: window - integer, size of the central window the offset is estimated on (None for the whole image)
+		para: max_shift - integer, largest offset searched for in pixels (None for any)
+		"""
+
+		self.crop = (slice(None), slice(None))
+		if window:
+			self.crop = tuple(slice(max((n - window)//2, 0), max((n - window)//2, 0) + window) for n in reference.shape)
+		reference = reference[self.crop]
+
+		self.shape = reference.shape
+		self.workers = workers
+		self.subpixel = subpixel
+		self.reference_spectrum = fft.rfft2(reference.astype(np.float64), workers=workers)
+
+		self.allowed = None
+		if max_shift is not None:
+			# circular distance of every correlation lag from zero shift
+			lags = [np.minimum(np.arange(n), n - np.arange(n)) <= max_shift for n in self.shape]
+			self.allowed = lags[0][:, None] & lags[1][None, :]
+
+	def offset(self, moving):
+		"""
+		offset which brings 'moving' onto the reference
+		para: moving - 2D array
+		return: (dx, dy) - tuple of the row and column offsets
+		"""
+
+		return tuple(float(shift) for shift in self.offsets(moving[np.newaxis])[0])
+
+	def offsets(self, stack):
+		"""
+		offsets of a stack of images, registered with one batched FFT
+		para: stack - 3D array (images, rows, cols)
+		return: offsets - 2D float64 array (images, 2) of the row and column offsets
+		"""
+
+		spectrum = fft.rfft2(stack[(slice(None),) + self.crop].astype(np.float64), workers=self.workers)
+		spectrum = np.conj(spectrum, out=spectrum)
+		spectrum *= self.reference_spectrum
+		R = fft.irfft2(spectrum, s=self.shape, workers=self.workers)
+
+		search = R if self.allowed is None else np.where(self.allowed, R, -np.inf)
+		peaks = np.unravel_index(np.argmax(search.reshape(len(R), -1), axis=1), self.shape)
+		offsets = np.empty((len(R), 2), dtype=np.float64)
+		for axis, (p, n) in enumerate(zip(peaks, self.shape)):
+			offsets[:, axis] = np.where(p > (n - 1)//2, p - n, p)
+			if self.subpixel and n > 2:
+				images = np.arange(len(R))
+				index = list(peaks)
+				peak = R[(images,) + tuple(index)]
+				index[axis] = (p - 1) % n
+				before = R[(images,) + tuple(index)]
+				index[axis] = (p + 1) % n
+				after = R[(images,) + tuple(index)]
+				curvature = before - 2*peak + after
+				refine = (curvature != 0) & (before <= peak) & (after <= peak) # a local maximum, not the edge of the search
+				offsets[refine, axis] += 0.5*(before[refine] - after[refine])/curvature[refine]
+
+		return offsets
+
+	def align(self, moving):
+		"""
+		para: moving - 2D array
+		return: corrected - 2D array aligned to the reference
+		"""
+
+		return shift_image(moving, self.offset(moving))
+
+
+def img_alignment(Ionomycin, Sample, Blank, window=None):
 	"""
 	image alignment based on cross-correlation
 	Ionomycin image is the reference image
 	para: Ionomycin, Sample, Blank - 2D array
+	para: window - integer, see ImageRegistration
 	return: Corrected_Sample, Corrected_Blank - 2D array
 	"""
 
-	centre_ = (Ionomycin.shape[0]/2, Ionomycin.shape[1]/2)
-	# 2d fourier transform of averaged images
-	FIonomycin = np.fft.fft2(Ionomycin)
-	FSample = np.fft.fft2(Sample)
-	FBlank = np.fft.fft2(Blank)
+	registration = ImageRegistration(Ionomycin, window=window)
+	Corrected_Sample = registration.align(Sample)
+	Corrected_Blank = registration.align(Blank)
 
-	# Correlation based on Ionomycin image
-	FRIS = FIonomycin*np.conj(FSample)
-	FRIB = FIonomycin*np.conj(FBlank)
+	return Corrected_Sample, Corrected_Blank
 
-	RIS = np.fft.ifft2(FRIS)
-	RIS = np.fft.fftshift(RIS)
-	RIB = np.fft.ifft2(FRIB)
-	RIB = np.fft.fftshift(RIB)
 
-	[i, j] = np.where(RIS == RIS.max())
-	[g, k] = np.where(RIB == RIB.max())
+def upsample_linear(small, shape, factor):
+	"""
+	linear interpolation of a grid of block values back to full resolution
+	The value of block i is taken at the centre of the block, i*factor + (factor-1)/2.
+	Both passes gather whole rows, the first one on the small grid.
+	para: small - 2D array, one value per factor x factor block
+	para: shape - tuple, full image shape
+	para: factor - integer
+	return: image - 2D float64 array of 'shape'
+	"""
 
-	# offset values
-	IS_x_offset = i-centre_[0]
-	IS_y_offset = j-centre_[1]
-	IB_x_offset = g-centre_[0]
-	IB_y_offset = k-centre_[1]
+	def interpolate_rows(grid, n_full):
+		n_small = grid.shape[0]
+		position = np.clip((np.arange(n_full) - (factor - 1)/2)/factor, 0, n_small - 1)
+		start = np.floor(position).astype(np.intp)
+		rows = grid[start]
+		rows += np.diff(grid, axis=0, append=grid[-1:])[start]*(position - start)[:, None]
+		return rows
 
-	# Correction
-	MIS = np.float64([[1, 0, IS_x_offset], [0, 1, IS_y_offset]])
-	Corrected_Sample = cv2.warpAffine(Sample, MIS, Ionomycin.shape)
-	MIB = np.float64([[1, 0, IB_x_offset], [0, 1, IB_y_offset]])
-	Corrected_Blank = cv2.warpAffine(Blank, MIB, Ionomycin.shape)
+	columns = interpolate_rows(np.ascontiguousarray(small.T, dtype=np.float64), shape[1])
+	return interpolate_rows(np.ascontiguousarray(columns.T), shape[0])
 
-	return Corrected_Sample, Corrected_Blank
 
+def background(image, size=32, factor=8):
+	"""
+	Smooth background of an image, such as uneven TIRF illumination.
+	The image is reduced to the mean of every factor x factor block, opened with a
+	square of 'size' pixels of the full image so no liposome survives, smoothed and
+	interpolated back, so the cost is a few passes over the image.
+	para: image - 2D array
+	para: size - integer, in pixels, larger than the largest liposome
+	para: factor - integer, downsampling factor
+	return: background - 2D float64 array with the shape of image
+	"""
+
+	rows, cols = image.shape
+	pad = (-rows % factor, -cols % factor)
+	blocks = np.pad(image, ((0, pad[0]), (0, pad[1])), mode='edge') if any(pad) else image
+	small = blocks.reshape(blocks.shape[0]//factor, factor, blocks.shape[1]//factor, factor).sum(axis=3, dtype=np.float32).sum(axis=1)/factor**2 # exact for 16 bit images
+
+	small = ndimage.grey_opening(small, size=max(int(round(size/factor)), 1), mode='nearest')
+	small = ndimage.uniform_filter(small, 3, mode='nearest')
 
-def peak_locating(data, threshold):
+	return upsample_linear(small, image.shape, factor)
+
+
+def flatten_background(image, size=32, factor=8):
+	"""
+	para: image - 2D array
+	para: size, factor - integer, see background
+	return: flattened - 2D float64 array, image minus its background
+	"""
+
+	return image - background(image, size, factor)
+
+
+class PeakCandidates:
+	"""
+	Local maxima of an image found once at the lowest threshold of a sweep.
+	The 3x3 max/min filters and the labelling are done here, so peaks for any
+	higher threshold can be selected from the candidates without repeating them.
+	"""
+
+	def __init__(self, data, threshold=0):
+		"""
+		para: data - 2D array
+		para: threshold - integer, lowest threshold that will be selected
+		"""
+
+		self.data = data
+		self.threshold = threshold
+
+		data_max = ndimage.maximum_filter(data, 3)
+		data_min = ndimage.minimum_filter(data, 3)
+		self.contrast_map = data_max - data_min
+		maxima = (data == data_max) & (self.contrast_map > threshold)
+
+		self.labeled, num_objects = ndimage.label(maxima)
+		index = np.arange(1, num_objects+1)
+		self.xy = np.array(ndimage.center_of_mass(data, self.labeled, index), dtype=np.float64).reshape(-1, 2)
+		self.contrast_min = np.array(ndimage.minimum(self.contrast_map, self.labeled, index), dtype=np.float64).reshape(-1)
+		self.contrast_max = np.array(ndimage.maximum(self.contrast_map, self.labeled, index), dtype=np.float64).reshape(-1)
+
+		# raster position of the first pixel of every candidate, which sets the label order
+		pixels = np.flatnonzero(self.labeled)
+		self.first_pixel = np.full(num_objects, self.labeled.size, dtype=np.intp)
+		np.minimum.at(self.first_pixel, self.labeled.ravel()[pixels] - 1, pixels)
+
+	def peaks(self, threshold):
+		"""
+		all peaks above 'threshold', in the order labelling the thresholded image would give them
+		Candidates whose pixels all clear 'threshold' are kept as they are; the few
+		which only partly clear it are labelled again from their surviving pixels.
+		para: threshold - integer, not lower than the threshold of the candidates
+		return: xy - 2D array of the centres of mass [[x1, y1], [x2, y2]...], not floored
+		return: contrast - 1D array, lowest 3x3 contrast over the pixels of each peak
+		return: index - 1D array, candidate each peak comes from (-1 if labelled again)
+		return: first_pixel - 1D array, raster position of the first pixel of each peak
+		"""
+
+		if threshold < self.threshold:
+			raise ValueError('Threshold ' + str(threshold) + ' is lower than the candidate threshold ' + str(self.threshold))
+
+		intact = self.contrast_min > threshold
+		partial = (self.contrast_max > threshold) & ~intact
+
+		index = np.flatnonzero(intact)
+		xy = self.xy[index]
+		contrast = self.contrast_min[index]
+		first_pixel = self.first_pixel[index]
+
+		if partial.any():
+			mask = np.isin(self.labeled, np.flatnonzero(partial) + 1) & (self.contrast_map > threshold)
+			labeled, num_objects = ndimage.label(mask)
+			new_index = np.arange(1, num_objects+1)
+			new_xy = np.array(ndimage.center_of_mass(self.data, labeled, new_index), dtype=np.float64).reshape(-1, 2)
+			new_contrast = np.array(ndimage.minimum(self.contrast_map, labeled, new_index), dtype=np.float64).reshape(-1)
+			pixels = np.flatnonzero(labeled)
+			new_first_pixel = np.full(num_objects, labeled.size, dtype=np.intp)
+			np.minimum.at(new_first_pixel, labeled.ravel()[pixels] - 1, pixels)
+
+			order = np.argsort(np.concatenate((first_pixel, new_first_pixel)), kind='stable')
+			xy = np.concatenate((xy, new_xy))[order]
+			contrast = np.concatenate((contrast, new_contrast))[order]
+			index = np.concatenate((index, np.full(num_objects, -1, dtype=index.dtype)))[order]
+			first_pixel = np.concatenate((first_pixel, new_first_pixel))[order]
+
+		return xy, contrast, index, first_pixel
+
+	def select(self, threshold, margin=30):
+		"""
+		peaks as peak_locating(data, threshold, margin) would find them
+		para: threshold - integer, not lower than the threshold of the candidates
+		para: margin - integer, border width in pixels
+		return: xy_thresh - 2D array [[x1, y1], [x2, y2]...]
+		return: contrast - 1D array, lowest 3x3 contrast over the pixels of each peak
+		return: index - 1D array, candidate each peak comes from (-1 if labelled again)
+		"""
+
+		xy, contrast, index, first_pixel = self.peaks(threshold)
+		inside = inside_margin(xy, self.data.shape, margin)
+
+		return np.floor(xy[inside]), contrast[inside], index[inside]
+
+
+def inside_margin(xy, shape, margin):
+	"""
+	para: xy - 2D array [[x1, y1], [x2, y2]...]
+	para: shape - tuple, image shape
+	para: margin - integer, border width in pixels
+	return: inside - 1D bool array, True for the points more than 'margin' pixels away from the border
+	"""
+
+	rows, cols = shape
+	return (xy[:, 0] > margin) & (xy[:, 0] < rows - margin) & (xy[:, 1] > margin) & (xy[:, 1] < cols - margin)
+
+
+def tile_slices(shape, tile_size, halo):
+	"""
+	Split an image into square tiles, each grown by a halo of 'halo' pixels on every
+	side that lies inside the image. Every pixel is in the core of exactly one tile.
+	para: shape - tuple, image shape
+	para: tile_size - integer, size of the tile cores, 0 for a single tile covering the image
+	para: halo - integer, in pixels
+	return: tiles - list of (core, padded), each a tuple of (row slice, column slice)
+	"""
+
+	rows, cols = shape
+	if tile_size <= 0:
+		whole = (slice(0, rows), slice(0, cols))
+		return [(whole, whole)]
+
+	tiles = []
+	for r0 in range(0, rows, tile_size):
+		for c0 in range(0, cols, tile_size):
+			r1, c1 = min(r0 + tile_size, rows), min(c0 + tile_size, cols)
+			core = (slice(r0, r1), slice(c0, c1))
+			padded = (slice(max(r0 - halo, 0), min(r1 + halo, rows)), slice(max(c0 - halo, 0), min(c1 + halo, cols)))
+			tiles.append((core, padded))
+	return tiles
+
+
+def cut_candidates(labeled, window, shape):
+	"""
+	Candidates of a window which may differ from the ones of the whole image.
+	The 3x3 filters are wrong on the outer row or column of a side of the window
+	which is inside the image, so a candidate is only known to be whole when none
+	of its pixels lies in the two outer rows or columns of such a side.
+	para: labeled - 2D integer array, labels of the candidates of the window
+	para: window - tuple of (row slice, column slice) in the image
+	para: shape - tuple, image shape
+	return: cut - 1D bool array, one value per candidate
+	"""
+
+	frame = np.zeros(labeled.shape, dtype=bool)
+	if window[0].start > 0:
+		frame[:2] = True
+	if window[0].stop < shape[0]:
+		frame[-2:] = True
+	if window[1].start > 0:
+		frame[:, :2] = True
+	if window[1].stop < shape[1]:
+		frame[:, -2:] = True
+
+	cut = np.zeros(labeled.max(initial=0), dtype=bool)
+	labels = labeled[frame]
+	cut[labels[labels > 0] - 1] = True
+	return cut
+
+
+def peak_locating(data, threshold, margin=30, return_contrast=False):
 	"""
 	Credit to Daniel
+	Local maxima whose 3x3 contrast (max - min) is above 'threshold' are labelled and
+	their centres of mass kept if they are more than 'margin' pixels away from the border.
 	para: data - 2D array
 	para: threshold - integer
+	para: margin - integer, border width in pixels, derived against the image shape
+	para: return_contrast - bool, also return the contrast of every peak
 	return: xy_thresh - 2D array [[x1, y1], [x2, y2]...]
+	return: contrast - 1D array, lowest 3x3 contrast over the pixels of each peak (if return_contrast)
 	"""
 
-	data_max = filters.maximum_filter(data, 3)
-	maxima = (data == data_max)
-	data_min = filters.minimum_filter(data, 3)
-	diff = ((data_max - data_min) > threshold)
-	maxima[diff == 0] = 0
-
-	labeled, num_objects = ndimage.label(maxima)
-	xy = np.array(ndimage.center_of_mass(data, labeled, range(1, num_objects+1)))
-	xy_thresh = np.zeros((0, 2))
-	for row in xy:
-		a = row[0]
-		b = row[1]
-		if (a > 30) and (a < 480) and (b > 30) and (b < 480):
-			ab = np.array([np.uint16(a), np.uint16(b)])
-			xy_thresh = np.vstack((xy_thresh, ab))
-	xy_thresh = xy_thresh[1:] 
+	xy_thresh, contrast, index = PeakCandidates(data, threshold).select(threshold, margin)
 
+	if return_contrast:
+		return xy_thresh, contrast
 	return xy_thresh
 
 
+def disk_offsets(radius):
+	"""
+	relative coordinates of all pixels within a 'radius' of a centre pixel
+	para: radius - integer
+	return: offsets - 2D array [[dx1, dy1], [dx2, dy2]...]
+	"""
+
+	r = int(radius)
+	dx, dy = np.mgrid[-r:r+1, -r:r+1]
+	inside = (dx**2 + dy**2) <= radius**2
+
+	return np.column_stack((dx[inside], dy[inside]))
+
+
+def aperture_index(shape, peak_coor, offsets):
+	"""
+	flat pixel indices of the aperture 'offsets' around every peak
+	para: shape - tuple, image shape
+	para: peak_coor - 2D array [[x1, y1], [x2, y2]...]
+	para: offsets - 2D array, from disk_offsets
+	return: flat_index - 2D array, one row of pixel indices per peak (clipped to the image)
+	return: inside - 2D bool array marking the pixels inside the image, None if all of them are
+	"""
+
+	peak_coor = np.rint(np.asarray(peak_coor, dtype=np.float64).reshape(-1, 2)).astype(np.intp)
+	rows = peak_coor[:, 0, None] + offsets[:, 0]
+	cols = peak_coor[:, 1, None] + offsets[:, 1]
+	inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+	if inside.all():
+		inside = None
+	else:
+		rows = np.clip(rows, 0, shape[0]-1)
+		cols = np.clip(cols, 0, shape[1]-1)
+
+	return np.ravel_multi_index((rows, cols), shape), inside
+
+
+def aperture_photometry(images, peak_coor, radius, split=False):
+	"""
+	Sum the pixels in a 'radius' around every peak on several images at once.
+	The disk offsets are computed once and all peaks are gathered in one go.
+	Pixels of an aperture which fall outside the image are not counted.
+	para: images - list of 2D array with the same shape, e.g. [Ionomycin, Sample, Blank]
+	para: peak_coor - 2D array [[x1, y1], [x2, y2]...]
+	para: radius - integer
+	para: split - bool, divide a pixel shared by the apertures of several of these peaks evenly between them
+	return: intensities - 2D float64 array [[I_image1, I_image2, ...], ...], one row per peak
+	"""
+
+	images = [np.asarray(img) for img in images]
+	flat_index, inside = aperture_index(images[0].shape, peak_coor, disk_offsets(radius))
+
+	share = None
+	if split:
+		# number of apertures every pixel belongs to
+		pixels, inverse = np.unique(flat_index, return_inverse=True)
+		inverse = inverse.reshape(flat_index.shape)
+		counted = np.ones(flat_index.shape) if inside is None else inside.astype(np.float64)
+		share = counted/np.maximum(np.bincount(inverse.ravel(), weights=counted.ravel(), minlength=len(pixels)), 1)[inverse]
+
+	intensities = np.empty((len(flat_index), len(images)), dtype=np.float64)
+	for k, img in enumerate(images):
+		pixels = img.ravel().take(flat_index)
+		if share is not None:
+			pixels = pixels*share
+		elif inside is not None:
+			pixels = np.where(inside, pixels, 0)
+		intensities[:, k] = pixels.sum(axis=1, dtype=np.float64)
+
+	return intensities
+
+
+def radial_profiles(images, peak_coor, max_radius):
+	"""
+	Cumulative aperture sums of every peak for all radii 1..max_radius in one pass.
+	The pixels of the largest disk are gathered once and summed ring by ring, where
+	a pixel at squared distance d2 belongs to every radius r with d2 <= r**2, as in
+	aperture_photometry.
+	para: images - list of 2D array with the same shape, e.g. [Ionomycin, Sample, Blank]
+	para: peak_coor - 2D array [[x1, y1], [x2, y2]...]
+	para: max_radius - integer
+	return: profiles - 3D float64 array (peaks, images, radii), profiles[:, k, r-1] is
+		aperture_photometry(images, peak_coor, r)[:, k]
+	"""
+
+	images = [np.asarray(img) for img in images]
+	max_radius = int(max_radius)
+	offsets = disk_offsets(max_radius)
+	flat_index, inside = aperture_index(images[0].shape, peak_coor, offsets)
+
+	# smallest radius whose disk holds each pixel, the centre pixel counts from radius 1
+	ring = np.maximum(np.ceil(np.sqrt((offsets**2).sum(axis=1))).astype(np.intp), 1)
+	rings = np.zeros((len(offsets), max_radius), dtype=np.float64)
+	rings[np.arange(len(offsets)), ring - 1] = 1
+
+	profiles = np.empty((len(flat_index), len(images), max_radius), dtype=np.float64)
+	for k, img in enumerate(images):
+		pixels = img.ravel().take(flat_index).astype(np.float64)
+		if inside is not None:
+			pixels[~inside] = 0
+		profiles[:, k, :] = np.cumsum(pixels @ rings, axis=1)
+
+	return profiles
+
+
+def influx_radius_sweep(profiles, high, low):
+	"""
+	influx of every peak for all radii 1..max_radius, from one radial_profiles pass
+	para: profiles - 3D array (peaks, images, radii), see radial_profiles
+	para: high, low - number, see influx_kernel
+	return: influx - 2D float64 array (peaks, radii), NaN where the influx is an error
+	return: error - 2D bool array (peaks, radii)
+	"""
+
+	return influx_kernel(profiles[:, 0], profiles[:, 1], profiles[:, 2], high, low)
+
+
+def neighbour_mask(peak_coor, distance):
+	"""
+	peaks with another peak within 'distance', found with a KD-tree in O(N log N)
+	Apertures of radius r around two peaks share pixels when the peaks are within 2r.
+	para: peak_coor - 2D array [[x1, y1], [x2, y2]...]
+	para: distance - float, in pixels
+	return: crowded - 1D bool array, one value per peak
+	"""
+
+	peak_coor = np.asarray(peak_coor, dtype=np.float64).reshape(-1, 2)
+	crowded = np.zeros(len(peak_coor), dtype=bool)
+	if len(peak_coor) > 1:
+		pairs = cKDTree(peak_coor).query_pairs(distance, output_type='ndarray')
+		crowded[pairs.ravel()] = True
+
+	return crowded
+
+
 def intensities(image_array, peak_coor, radius):
 	"""
 	When the local peak is found, extract all the coordinates of pixels in a 'radius'
@@ -132,23 +684,10 @@ def intensities(image_array, peak_coor, radius):
 	return: intensities - 2D array [[I1], [I2]]
 	"""
 
-	x_ind, y_ind = np.indices(image_array.shape)
-	intensities = np.zeros((0,1))
-	#intensities = []
-	for (x, y) in peak_coor:
-		intensity = 0
-		circle_points = ((x_ind - x)**2 + (y_ind - y)**2) <= radius**2
-		coor = np.where(circle_points == True)
-		coor = np.array(list(zip(coor[0], coor[1])))
-		for j in coor:
-			intensity += image_array[j[0], j[1]]
-		intensities = np.vstack((intensities, intensity))
-		#intensities.append(intensity)
+	return aperture_photometry([image_array], peak_coor, radius)
 
-	return intensities
-	#return np.array(intensities)
 
-def influx_calculation(Ionomycin, Sample, Blank, peak_coor, high, low, radius):
+def influx_kernel(ionomycin, sample, blank, high, low):
 	"""
 	Equation is:
 		(F_Sample-F_Blank)*100/(F_Ionomycin-F_Blank)
@@ -157,6 +696,30 @@ def influx_calculation(Ionomycin, Sample, Blank, peak_coor, high, low, radius):
 				100%-high limited				  100%
 				0-100%							  itself
 				low limited-0					  0
+	para: ionomycin, sample, blank - 1D array, intensities of the peaks
+	para: high, low - number
+	return: influx - 1D float64 array, NaN where the influx is an error
+	return: error - 1D bool array, True where the influx is an error
+	"""
+
+	ionomycin = np.asarray(ionomycin, dtype=np.float64)
+	sample = np.asarray(sample, dtype=np.float64)
+	blank = np.asarray(blank, dtype=np.float64)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		influx = (sample - blank) / (ionomycin - blank) * 100
+
+	influx[(influx >= 100) & (influx <= high)] = 100
+	influx[(influx <= 0) & (influx >= low)] = 0
+	error = np.isnan(influx) | (influx < low) | (influx > high)
+	influx[error] = np.nan
+
+	return influx, error
+
+
+def influx_calculation(Ionomycin, Sample, Blank, peak_coor, high, low, radius):
+	"""
+	Influx of every peak, see influx_kernel for the equation and the limits
 	para: Ionomycin, Sample, Blank - 2D array
 	para: peak_coor - pd.DataFrame {x:, y:}
 	para: radius, high, low - integer
@@ -164,24 +727,170 @@ def influx_calculation(Ionomycin, Sample, Blank, peak_coor, high, low, radius):
 	return: error - integer
 	"""
 
-	error = 0
 	results = pd.DataFrame(peak_coor)
 
 	results.columns=['field', 'x', 'y', 'ionomycin', 'sample', 'blank']
-	results['influx'] = (results['sample'] - results['blank']) / (results['ionomycin'] - results['blank']) * 100
+	influx, error_mask = influx_kernel(results['ionomycin'].values, results['sample'].values, results['blank'].values, high, low)
+	results['influx'] = influx
+	error = int(error_mask.sum())
 
-	results['influx'] = [100 if i >= 100 and i <= high else i for i in results['influx']]
-	results['influx'] = [0 if i <= 0 and i >= low else i for i in results['influx']]
-	results['influx'] = ['error' if ms.isnan(np.float(i)) or i < low or i > high else i for i in results['influx']]
+	results = results[~error_mask]
 
-	try:
-		error = (results.influx.values == 'error').sum()
-	except (AttributeError, FutureWarning) as e:
-		error = 0
+	return results, error
 
-	results = results[results.influx != 'error']
+FRAME_SETTINGS = {'RegistrationWindow': 0, 'DriftCorrection': False, 'DriftWindow': 256, 'DriftMax': 10} # settings the averaged and aligned images depend on, with their defaults
+
+class CalciumSample:
+	"""
+	One sample folder with Ionomycin, Sample and Blank subfolders, analysed lazily.
+	Fields are found on first use, every field is averaged and aligned only when it
+	is first needed, and the peak candidates and photometry of a field are kept, so
+	peak_location/influx at several thresholds reuse all the earlier work.
+	"""
+
+	items = ['Main', 'Ionomycin', 'Sample', 'Blank']
+
+	def __init__(self, path, Holder, frameCache=None, fields=None):
+		"""
+		para: path - string, sample folder
+		para: Holder - dict of settings {Threshold:, Radius:, High:, Low:}, and FRAME_SETTINGS if not the defaults
+		para: frameCache - field_cache.FrameCache or None, store of averaged and aligned images, shared with main
+		para: fields - list of string, fields to analyse, e.g. from dataset_index (None for all complete ones)
+		"""
+
+		self.path = path
+		self.Holder = dict(Holder)
+		self.frameCache = frameCache
+		self.folders = [path] + [os.path.join(path, item) for item in self.items[1:]]
+		self.error_report = {
+			'path': [int(os.path.isdir(folder)) for folder in self.folders],
+			'influx': {}
+		}
+
+		self.threshold = None
+		self._fields = None if fields is None else list(fields)
+		self._images = {}
+		self._candidates = {}
+		self._photometry = {}
+		self._peaks = {}
+
+	@property
+	def fields(self):
+		"""
+		tiff files present in all of the Ionomycin, Sample and Blank folders
+		"""
+
+		if self._fields is None:
+			names = [set(extract_filename(folder)) for folder in self.folders[1:]]
+			self._fields = sorted(names[0] & names[1] & names[2])
+		return self._fields
+
+	def images(self, field):
+		"""
+		para: field - string, tiff file name
+		return: images - list of 2D array [Ionomycin, Sample aligned, Blank aligned]
+		"""
+
+		if field not in self._images:
+			paths = [os.path.join(folder, field) for folder in self.folders[1:]]
+			settings = {name: self.Holder.get(name, default) for name, default in FRAME_SETTINGS.items()}
+			frames = None
+			if self.frameCache is not None:
+				key = self.frameCache.key(paths, settings)
+				frames = self.frameCache.load(key)
+
+			if frames is not None:
+				self._images[field] = [frames[0], frames[1], frames[2]]
+			else:
+				if settings['DriftCorrection']:
+					means = [drift_corrected_average(path, window=int(settings['DriftWindow']) or None, max_drift=int(settings['DriftMax']))[0] for path in paths]
+				else:
+					means = [average_frame(path) for path in paths]
+				ionomycin, sample, blank = means
+				sample, blank = img_alignment(ionomycin, sample, blank, int(settings['RegistrationWindow']) or None)
+				self._images[field] = [ionomycin, sample, blank]
+				if self.frameCache is not None:
+					self.frameCache.store(key, np.stack(self._images[field]))
+
+		return self._images[field]
+
+	def img_correction(self):
+		"""
+		average and align every field now instead of on first use
+		"""
+
+		for field in self.fields:
+			self.images(field)
+
+	def candidates(self, field):
+		"""
+		peak candidates of a field, found once at the lowest threshold in Holder['Threshold']
+		para: field - string
+		return: candidates - PeakCandidates
+		"""
+
+		if field not in self._candidates:
+			thresholds = [int(thre) for thre in str(self.Holder['Threshold']).split('/') if thre.strip().isdigit()]
+			if self.threshold is not None:
+				thresholds.append(self.threshold)
+			self._candidates[field] = PeakCandidates(self.images(field)[0], min(thresholds))
+		elif self.threshold is not None and self.threshold < self._candidates[field].threshold:
+			# a threshold below the candidates, the peaks kept so far for this field refer to the old candidates
+			self._candidates[field] = PeakCandidates(self.images(field)[0], self.threshold)
+			self._photometry = {key: value for key, value in self._photometry.items() if key[0] != field}
+			self._peaks = {thre: {name: found for name, found in peaks.items() if name != field} for thre, peaks in self._peaks.items()}
+		return self._candidates[field]
+
+	def peak_location(self, threshold, fields=None):
+		"""
+		locate the peaks of every field at 'threshold', which is used by the next influx()
+		para: threshold - integer
+		para: fields - list of string, only these fields (None for all)
+		return: peaks - dict {field: 2D array [[x1, y1], [x2, y2]...]}
+		"""
+
+		self.threshold = int(threshold)
+		fields = self.fields if fields is None else fields
+		for field in fields:
+			if field not in self._peaks.get(self.threshold, {}):
+				found = self.candidates(field).select(self.threshold)
+				self._peaks.setdefault(self.threshold, {})[field] = found
+		return {field: self._peaks[self.threshold][field][0] for field in fields}
+
+	def influx(self, fields=None):
+		"""
+		influx of every peak found by the last peak_location()
+		the number of errors of every field is kept in error_report['influx'][threshold]
+		para: fields - list of string, only these fields (None for all), numbered by their place in self.fields
+		return: results - dict {field: pd.DataFrame {field:, x:, y:, ionomycin:, sample:, blank:, influx:}}
+		"""
+
+		if self.threshold is None:
+			raise ValueError('peak_location() must be called before influx().')
+
+		radius = int(self.Holder['Radius'])
+		results = {}
+		errors = {}
+		for c, field in enumerate(self.fields, 1):
+			if fields is not None and field not in fields:
+				continue
+			images = self.images(field)
+			candidates = self.candidates(field)
+			peaks, contrast, index = self._peaks[self.threshold][field]
+
+			if (field, radius) not in self._photometry:
+				self._photometry[(field, radius)] = aperture_photometry(images, np.floor(candidates.xy), radius)
+			inten = self._photometry[(field, radius)][index]
+			relabelled = index < 0
+			if relabelled.any():
+				inten[relabelled] = aperture_photometry(images, peaks[relabelled], radius)
+
+			peak_coor = np.column_stack((np.full(len(peaks), c), peaks, inten))
+			results[field], errors[field] = influx_calculation(*images, peak_coor, self.Holder['High'], self.Holder['Low'], radius)
+
+		self.error_report['influx'].setdefault(self.threshold, {}).update(errors)
+		return results
 
-	return results, error
 
 if __name__ == '__main__':
 	
@@ -205,7 +914,7 @@ if __name__ == '__main__':
 	time_list = []
 	while test_round <= 0:
 
-		tic = time.clock()
+		tic = time.perf_counter()
 
 		### get all samples in the folder ###
 		sampleNames = [name for name in os.listdir(Holder['PATH']) if not name.startswith('.')]
@@ -241,25 +950,12 @@ if __name__ == '__main__':
 				peaks = peak_locating(ionomycinMean, 80)
 				
 				### Calculate the intensities of peaks with certain radius (in pixel) ###
-				ionInten = intensities(ionomycinMean, peaks, 3)
-				samInten = intensities(sampleMean, peaks, 3)
-				blaInten = intensities(blankMean, peaks, 3)
+				inten = aperture_photometry([ionomycinMean, sampleMean, blankMean], peaks, 3)
+				ionInten, samInten, blaInten = inten[:, [0]], inten[:, [1]], inten[:, [2]]
 				
-				influx = pd.DataFrame((samInten - blaInten)/(ionInten - blaInten)*100, columns=['Influx'])
-				
-				### for test ###
-				#influx = influx.append({'Influx': float('nan')}, ignore_index=True)
-
-				influx['Influx'] = [100 if i >= 100 and i <= 200 else i for i in influx['Influx']]
-				influx['Influx'] = [0 if i <= 0 and i >= -100 else i for i in influx['Influx']]
-				influx['Influx'] = ['error' if ms.isnan(np.float(i)) or i < -100 or i > 200 else i for i in influx['Influx']]
-
-				try:
-					err += (influx.Influx.values == 'error').sum()
-				except (AttributeError, FutureWarning) as e:
-					err += 0
-
-				influx = influx[influx.Influx != 'error']
+				influxValues, errorMask = influx_kernel(ionInten[:, 0], samInten[:, 0], blaInten[:, 0], Holder['High'], Holder['Low'])
+				influx = pd.DataFrame(influxValues, columns=['Influx'])
+				err += int(errorMask.sum())
 
 
 				### Generate a dataframe which contains the result of current field of view ###
@@ -292,7 +988,7 @@ if __name__ == '__main__':
 		sampleSummary_df = pd.DataFrame.from_dict(sampleSummary, orient='index', columns=['Influx'])
 		sampleSummary_df.to_csv(resultPath + '/summary.csv')
 
-		toc = time.clock()
+		toc = time.perf_counter()
 		time_list.append(toc-tic)
 		print(str(test_round))
 		test_round += 1
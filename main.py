@@ -1,117 +1,759 @@
-import local_tools 
+import local_tools
+import result_sink
+import field_cache
+import profiling
+import prefetch
+import dataset_index
+import cProfile
 import os
 import pandas as pd
-import math as ms
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-mainPath = r"C:\Users\zx252\Documents\20191205\20191205_Dimitri_Soaked_brain"
+Holder = {
+	'PATH' : r"C:\Users\zx252\Documents\20191205\20191205_Dimitri_Soaked_brain",
+	'Threshold' : '200', # several thresholds can be swept at once, e.g. '80/120/200'
+	'Radius' : '3',
+	'RadiusSweep' : 0, # if larger than 0, also measure the influx for every radius 1..RadiusSweep, in raw/<sample>_radius and radius.csv
+	'TileSize' : 0, # if larger than 0, find and measure peaks in tiles of this size, for large frames
+	'TileWorkers' : 1, # number of threads running the tiles of a field
+	'RegistrationWindow' : 0, # if larger than 0, estimate the alignment on a central window of this size
+	'DriftCorrection' : False, # register every frame of a stack before averaging, drift traces in results/drift
+	'DriftWindow' : 256, # size of the central window the drift is estimated on, 0 for whole frames
+	'DriftMax' : 10, # largest drift within a stack in pixels
+	'Background' : 0, # if larger than 0, subtract the smooth background from the averaged images, size in pixels larger than a liposome
+	'BackgroundFactor' : 8, # downsampling of the images the background is estimated on
+	'Neighbours' : 'keep', # peaks whose apertures overlap: 'keep', 'flag' (Neighbour column), 'drop' or 'split' shared pixels
+	'NeighbourDistance' : 0, # distance in pixels under which two peaks are neighbours, 0 for twice the radius
+	'QC' : 'off', # quick check of every field on a few Ionomycin frames first: 'off', 'flag' or 'skip' failing fields
+	'QCFrames' : 3, # number of frames the check reads
+	'QCMinFocus' : 0, # fields with a lower focus metric fail, see local_tools.field_qc
+	'QCMaxSaturation' : 0.01, # fields with a larger fraction of saturated pixels fail
+	'QCMinDensity' : 0.5, # fields with fewer spots per 10^4 pixels fail
+	'High' : 200,
+	'Low' : -100,
+	'Workers' : 1, # number of processes, fields are run in parallel if larger than 1
+	'Prefetch' : 0, # number of fields read ahead while the current one is analysed (with Workers 1)
+	'PrefetchMemory' : 1, # memory limit of the fields read ahead in GB
+	'IOWorkers' : 3, # number of threads reading ahead
+	'Format' : 'csv', # 'csv', 'parquet' or 'feather' for the raw results
+	'ExportCSV' : False, # also write a csv copy of parquet/feather results
+	'Incremental' : False, # reuse cached results of fields whose inputs and parameters did not change
+	'HashInputs' : False, # identify input files by content hash instead of size and modification time
+	'FrameCache' : False, # keep averaged and aligned images in PATH/.frame_cache for re-analysis
+	'FrameCacheSize' : 2, # size limit of the frame cache in GB
+	'Profile' : False, # record time per stage and field in results/profile.csv and .json
+	'ProfileMemory' : False, # also record peak memory per stage (slower)
+	'ProfileDump' : False # save a cProfile dump of the main process in results/profile.prof
+}
 
+OUTPUT_COLUMNS = ['Field', 'X', 'Y', 'Influx']
+NEIGHBOUR_MODES = ['keep', 'flag', 'drop', 'split']
+FIELD_PARAMETERS = ['Threshold', 'Radius', 'RadiusSweep', 'TileSize', 'RegistrationWindow', 'DriftCorrection', 'DriftWindow', 'DriftMax', 'Background', 'BackgroundFactor', 'Neighbours', 'NeighbourDistance', 'QC', 'QCFrames', 'QCMinFocus', 'QCMaxSaturation', 'QCMinDensity', 'High', 'Low'] # settings the result of a field depends on
+FRAME_PARAMETERS = list(local_tools.FRAME_SETTINGS) # settings the averaged and aligned images depend on, keyed alike by local_tools.CalciumSample
+TILE_HALO = 4 # pixels added to the aperture radius around every tile, room for the 3x3 filters and the extent of most peaks
 
-print('Starting...')
 
-if not os.path.isdir(mainPath):
-	print('Data folder does not exist. Exit.')
-	quit()
+def output_columns(Holder):
+	"""
+	para: Holder - dict of settings
+	return: columns - list of string, columns of the raw result of a sample
+	"""
 
-resultPath = mainPath + '/results'
+	return OUTPUT_COLUMNS + (['Neighbour'] if Holder.get('Neighbours', 'keep') == 'flag' else [])
 
-### get all samples in the folder ###
-sampleNames = [name for name in os.listdir(mainPath) if not name.startswith('.') or name == 'results']
-sampleSummary = []
 
-### Loop over all samples ###
-for sample in sampleNames:
+def qc_reason(metrics, Holder):
+	"""
+	para: metrics - dict, see local_tools.field_qc
+	para: Holder - dict of settings with the QC limits
+	return: reason - string, why the field fails the check, '' if it passes
+	"""
 
-	print('Running sample: ' + sample)
-	sampleErr = 0
+	reasons = []
+	if metrics['focus'] < float(Holder.get('QCMinFocus', 0)):
+		reasons.append('out of focus')
+	if metrics['saturation'] > float(Holder.get('QCMaxSaturation', 1)):
+		reasons.append('saturated')
+	if metrics['density'] < float(Holder.get('QCMinDensity', 0)):
+		reasons.append('no spots')
+	return ', '.join(reasons)
 
-	### Set the paths ###
-	ionomycinPath = mainPath + '/' + sample + '/Ionomycin/'
-	samplePath = mainPath + '/' + sample + '/Sample/'
-	blankPath = mainPath + '/' + sample + '/Blank/'
 
-	if not os.path.isdir(ionomycinPath):
-		print('Skip ' + sample + ' since data not found in the sample folder.')
-		continue
+def sweep_columns(Holder):
+	"""
+	para: Holder - dict of settings
+	return: columns - list of string, 'Influx_r1'... of the radius sweep, empty if there is none
+	"""
 
-	sampleOutput = pd.DataFrame()
+	return ['Influx_r' + str(r) for r in range(1, int(Holder.get('RadiusSweep', 0)) + 1)]
 
-	### Obtain filenames for fields of view ###
-	fieldNames = local_tools.extract_filename(ionomycinPath)
-	fieldSummary = []
 
-	### Loop over all fields of views ###
-	for c, field in enumerate(fieldNames, 1):
+def read_frames(ionomycinPath, samplePath, blankPath, field, Holder, frameCache=None, profiler=None):
+	"""
+	Averaged Ionomycin, Sample and Blank images of a field, or the aligned images if 'frameCache' holds them.
+	para: ionomycinPath, samplePath, blankPath - string, folders ending with '/'
+	para: field - string, tiff file name of the field
+	para: Holder - dict of settings
+	para: frameCache - field_cache.FrameCache or None
+	para: profiler - profiling.StageProfiler or None
+	return: frames - tuple (images, aligned, key)
+		images - list of 2D array [Ionomycin, Sample, Blank]
+		aligned - bool, the images come from the frame cache and are aligned already
+		key - string, frame cache key of the field, None without a frame cache
+	"""
 
-		### Average tiff files ###
-		ionomycinMean = local_tools.average_frame(ionomycinPath + field)
-		sampleMean = local_tools.average_frame(samplePath + field)
-		blankMean = local_tools.average_frame(blankPath + field)
+	key = None
+	if frameCache is not None:
+		paths = [ionomycinPath + field, samplePath + field, blankPath + field]
+		key = frameCache.key(paths, {name: Holder[name] for name in FRAME_PARAMETERS})
+		with profiling.stage(profiler, 'frame_cache_read'):
+			frames = frameCache.load(key)
+		if frames is not None:
+			return [frames[0], frames[1], frames[2]], True, key
 
-		### Align blank and sample images to the ionomycin image ###
-		sampleAligned, blankAligned = local_tools.img_alignment(ionomycinMean, sampleMean, blankMean)
+	### Average tiff files, registering every frame if drift is corrected ###
+	if Holder.get('DriftCorrection', False):
+		means, drift = [], {}
+		for stack, folder in zip(['Ionomycin', 'Sample', 'Blank'], [ionomycinPath, samplePath, blankPath]):
+			mean, drift[stack] = local_tools.drift_corrected_average(folder + field, window=int(Holder.get('DriftWindow', 0)) or None,
+				max_drift=int(Holder.get('DriftMax', 10)), profiler=profiler)
+			means.append(mean)
+		save_drift(ionomycinPath, field, drift)
+		return means, False, key
+
+	ionomycinMean = local_tools.average_frame(ionomycinPath + field, profiler=profiler)
+	sampleMean = local_tools.average_frame(samplePath + field, profiler=profiler)
+	blankMean = local_tools.average_frame(blankPath + field, profiler=profiler)
+
+	return [ionomycinMean, sampleMean, blankMean], False, key
+
+
+def save_drift(ionomycinPath, field, drift):
+	"""
+	write the drift trace of a field to 'results/drift/<sample>/<field>.csv' of its plate
+	para: ionomycinPath - string, '<plate>/<sample>/Ionomycin/'
+	para: field - string, tiff file name of the field
+	para: drift - dict {stack: 2D array (frames, 2)}, see local_tools.drift_corrected_average
+	"""
+
+	samplePath = os.path.dirname(os.path.normpath(ionomycinPath))
+	driftPath = os.path.join(os.path.dirname(samplePath), 'results', 'drift', os.path.basename(samplePath))
+	os.makedirs(driftPath, exist_ok=True)
+
+	trace = pd.concat([pd.DataFrame({'Stack': stack, 'Frame': np.arange(len(offsets)), 'DX': offsets[:, 0], 'DY': offsets[:, 1]})
+		for stack, offsets in drift.items()], ignore_index=True)
+	trace.to_csv(os.path.join(driftPath, os.path.splitext(field)[0] + '.csv'), index=False)
+
+
+def prefetch_frames(ionomycinPath, samplePath, blankPath, field, c, Holder, frameCache=None):
+	"""
+	read_frames with a profiler of its own, to be run on a read-ahead thread
+	para: as process_field
+	return: frames - as read_frames, None if the reading failed, the field is then read again by process_field
+	return: stages - dict, profiling.StageProfiler.stages of the reading, None if Holder['Profile'] is off
+	"""
+
+	profiler = profiling.StageProfiler() if Holder.get('Profile', False) else None
+	try:
+		frames = read_frames(ionomycinPath, samplePath, blankPath, field, Holder, frameCache, profiler)
+	except Exception:
+		frames = None
+
+	return frames, None if profiler is None else profiler.stages
+
+
+def field_images(ionomycinPath, samplePath, blankPath, field, Holder, frameCache=None, profiler=None, frames=None):
+	"""
+	Averaged Ionomycin image and the Sample and Blank images aligned to it.
+	They are read from 'frameCache' if it holds them, and stored in it otherwise.
+	para: ionomycinPath, samplePath, blankPath - string, folders ending with '/'
+	para: field - string, tiff file name of the field
+	para: Holder - dict of settings
+	para: frameCache - field_cache.FrameCache or None
+	para: profiler - profiling.StageProfiler or None
+	para: frames - tuple, read_frames of the field if it was read ahead
+	return: images - list of 2D array [Ionomycin, Sample, Blank]
+	"""
+
+	if frames is None:
+		frames = read_frames(ionomycinPath, samplePath, blankPath, field, Holder, frameCache, profiler)
+	(ionomycinMean, sampleMean, blankMean), aligned, key = frames
+	if aligned:
+		return [ionomycinMean, sampleMean, blankMean]
+
+	### Align blank and sample images to the ionomycin image ###
+	with profiling.stage(profiler, 'alignment'):
+		sampleAligned, blankAligned = local_tools.img_alignment(ionomycinMean, sampleMean, blankMean, int(Holder.get('RegistrationWindow', 0)) or None)
+	images = [ionomycinMean, sampleAligned, blankAligned]
+
+	if frameCache is not None:
+		frameCache.store(key, np.stack(images))
+
+	return images
+
+
+def skipped_field(Holder, reason):
+	"""
+	results of a field which is not analysed, no peak and the reason in fieldOutput['QC']
+	para: Holder - dict of settings
+	para: reason - string
+	return: fieldResults - dict {threshold: (fieldOutput, fieldErr)}, see process_field
+	"""
+
+	dtypes = {'Field': np.int64, 'Neighbour': bool}
+	fieldOutput = {column: np.array([], dtype=dtypes.get(column, np.float64)) for column in output_columns(Holder) + sweep_columns(Holder)}
+	fieldOutput['QC'] = np.array(['skipped: ' + reason])
+	return {threshold: (fieldOutput, 0) for threshold in threshold_list(Holder)}
+
+
+def measure_window(images, window, candidates, keep, thresholds, radius, sweep, profiler=None):
+	"""
+	Peaks of every threshold from some of the candidates of a window, and their photometry.
+	The candidates are measured once at the lowest threshold; the peaks of a higher
+	threshold belong to the candidate holding their first pixel.
+	para: images - list of 2D array [Ionomycin, Sample, Blank], the whole field
+	para: window - tuple of (row slice, column slice)
+	para: candidates - local_tools.PeakCandidates of the Ionomycin image in the window, at the lowest threshold
+	para: keep - 1D bool array, the candidates whose peaks are returned
+	para: thresholds - list of integer
+	para: radius, sweep - integer, aperture radius and radius sweep (0 for none)
+	para: profiler - profiling.StageProfiler or None
+	return: windowResults - dict {threshold: (xy, first_pixel, inten, profiles)} in field coordinates
+		xy - 2D array of the centres of mass, not floored
+		first_pixel - 1D array, raster position in the field of the first pixel of each peak
+		inten - 2D array, see local_tools.aperture_photometry
+		profiles - 3D array, see local_tools.radial_profiles, None without a sweep
+	"""
+
+	windowImages = [image[window] for image in images]
+	origin = np.array([window[0].start, window[1].start])
+	width = windowImages[0].shape[1]
+	fieldWidth = images[0].shape[1]
+
+	with profiling.stage(profiler, 'photometry'):
+		if sweep > 0:
+			candidateProfiles = local_tools.radial_profiles(windowImages, np.floor(candidates.xy), sweep)
+		if 0 < radius <= sweep:
+			candidateInten = candidateProfiles[:, :, radius-1]
+		else:
+			candidateInten = local_tools.aperture_photometry(windowImages, np.floor(candidates.xy), radius)
+
+	windowResults = {}
+	for threshold in thresholds:
+
+		### Select the peaks above this threshold which come from the kept candidates ###
+		with profiling.stage(profiler, 'peak_detection'):
+			xy, contrast, index, first_pixel = candidates.peaks(threshold)
+			kept = keep[candidates.labeled.ravel()[first_pixel] - 1]
+			xy, index, first_pixel = xy[kept] + origin, index[kept], first_pixel[kept]
+			first_pixel = (first_pixel//width + origin[0])*fieldWidth + first_pixel%width + origin[1]
+
+		### Take the intensities of the candidates, re-measure the peaks labelled again ###
+		with profiling.stage(profiler, 'photometry'):
+			relabelled = index < 0
+			peaks = np.floor(xy[relabelled]) - origin
+			inten = candidateInten[index]
+			if relabelled.any():
+				inten[relabelled] = local_tools.aperture_photometry(windowImages, peaks, radius)
+			profiles = None
+			if sweep > 0:
+				profiles = candidateProfiles[index]
+				if relabelled.any():
+					profiles[relabelled] = local_tools.radial_profiles(windowImages, peaks, sweep)
+
+		windowResults[threshold] = (xy, first_pixel, inten, profiles)
+
+	return windowResults
+
+
+def measure_tile(images, core, padded, thresholds, radius, sweep, profiler=None):
+	"""
+	Peaks of every threshold in one tile of a field and their photometry.
+	The peak candidates are found on the tile grown by its halo, and a tile keeps the
+	candidates whose first pixel lies in its core, so every candidate has one owner.
+	While a candidate with pixels in the core reaches the edge of the halo, and so may
+	be cut off or changed there, the halo is doubled, at most up to the whole field;
+	the candidates the tile keeps are then the ones of the whole field.
+	para: images - list of 2D array [Ionomycin, Sample, Blank], the whole field
+	para: core, padded - tuple of (row slice, column slice), see local_tools.tile_slices
+	para: thresholds - list of integer
+	para: radius, sweep - integer, aperture radius and radius sweep (0 for none)
+	para: profiler - profiling.StageProfiler or None
+	return: tileResults - dict {threshold: (xy, first_pixel, inten, profiles)}, see measure_window
+	"""
+
+	shape = images[0].shape
+	halo = max(core[0].start - padded[0].start, padded[0].stop - core[0].stop, core[1].start - padded[1].start, padded[1].stop - core[1].stop)
+
+	with profiling.stage(profiler, 'peak_detection'):
+		while True:
+			candidates = local_tools.PeakCandidates(images[0][padded], min(thresholds))
+			inner = tuple(slice(part.start - window.start, part.stop - window.start) for part, window in zip(core, padded))
+			labels = candidates.labeled[inner]
+			cut = local_tools.cut_candidates(candidates.labeled, padded, shape)
+			if not cut[labels[labels > 0] - 1].any():
+				break
+			halo *= 2
+			padded = tuple(slice(max(part.start - halo, 0), min(part.stop + halo, size)) for part, size in zip(core, shape))
+
+		width = padded[1].stop - padded[1].start
+		rows = candidates.first_pixel//width + padded[0].start
+		cols = candidates.first_pixel%width + padded[1].start
+		owned = (rows >= core[0].start) & (rows < core[0].stop) & (cols >= core[1].start) & (cols < core[1].stop)
+
+	return measure_window(images, padded, candidates, owned, thresholds, radius, sweep, profiler)
+
+
+def process_field(ionomycinPath, samplePath, blankPath, field, c, Holder, frameCache=None, profiler=None, frames=None):
+	"""
+	Run the whole analysis on one field of view for every threshold in Holder['Threshold'].
+	The peak candidates and their photometry are computed once at the lowest threshold
+	and shared by all thresholds of the sweep. With Holder['RadiusSweep'] the radial
+	profiles of the candidates give the influx of every radius from the same pass.
+	With Holder['TileSize'] the field is split into tiles with a halo of the aperture
+	radius plus TILE_HALO, measured in Holder['TileWorkers'] threads and merged in the
+	order of the whole field. Every peak candidate belongs to the tile holding its first
+	pixel, and a tile grows its halo around candidates wider than it, so peaks on the
+	seams are found once and as on the whole field.
+	Peaks closer than Holder['NeighbourDistance'] share aperture pixels and are kept,
+	flagged, dropped or have the shared pixels split between them (Holder['Neighbours']);
+	the radius sweep is measured without splitting.
+	With Holder['Background'] the smooth background of every averaged image is
+	subtracted before the peaks are located and measured, see local_tools.background.
+	With Holder['QC'] a few Ionomycin frames are checked first; fields failing the check
+	are skipped before their stacks are read, or flagged, with the reason in fieldOutput['QC'].
+	Every field is independent, so this can be run in a separate process.
+	para: ionomycinPath, samplePath, blankPath - string, folders ending with '/'
+	para: field - string, tiff file name of the field
+	para: c - integer, number of the field in the sample
+	para: Holder - dict of settings
+	para: frameCache - field_cache.FrameCache or None, store of averaged and aligned images
+	para: profiler - profiling.StageProfiler or None, records the time spent in every stage
+	para: frames - tuple, read_frames of the field if it was read ahead
+	return: fieldResults - dict {threshold: (fieldOutput, fieldErr)}
+		fieldOutput - dict of 1D array {Field:, X:, Y:, Influx:}, plus Neighbour when flagged and Influx_r1... with a radius sweep,
+			and QC, an array of one string 'skipped: <reason>' or 'flagged: <reason>', if the field failed the check
+		fieldErr - integer
+	"""
+
+	thresholds = threshold_list(Holder)
+	radius = int(Holder['Radius'])
+	sweep = int(Holder.get('RadiusSweep', 0))
+	neighbours = Holder.get('Neighbours', 'keep')
+	if neighbours not in NEIGHBOUR_MODES:
+		raise ValueError('Unknown neighbour mode: ' + str(neighbours))
+	distance = float(Holder.get('NeighbourDistance', 0)) or 2*radius
+
+	### Check the field on a few frames before reading all of it ###
+	qc = Holder.get('QC', 'off')
+	reason = ''
+	if qc != 'off':
+		with profiling.stage(profiler, 'qc'):
+			reason = qc_reason(local_tools.field_qc(ionomycinPath + field, min(thresholds), int(Holder.get('QCFrames', 3))), Holder)
+	if reason and qc == 'skip':
+		return skipped_field(Holder, reason)
+
+	### Averaged and aligned images ###
+	images = field_images(ionomycinPath, samplePath, blankPath, field, Holder, frameCache, profiler, frames)
+
+	### Flatten uneven illumination, the frame cache keeps the images as they were read ###
+	backgroundSize = int(Holder.get('Background', 0))
+	if backgroundSize > 0:
+		with profiling.stage(profiler, 'background'):
+			images = [local_tools.flatten_background(image, backgroundSize, int(Holder.get('BackgroundFactor', 8))) for image in images]
+
+	### Locate and measure the peaks tile by tile ###
+	tiles = local_tools.tile_slices(images[0].shape, int(Holder.get('TileSize', 0)), max(radius, sweep) + TILE_HALO)
+	tileWorkers = int(Holder.get('TileWorkers', 1))
+	if tileWorkers > 1 and len(tiles) > 1:
+		# the stages of parallel tiles overlap, so they are timed together
+		with profiling.stage(profiler, 'tiles'), ThreadPoolExecutor(max_workers=tileWorkers) as pool:
+			tileResults = list(pool.map(lambda tile: measure_tile(images, *tile, thresholds, radius, sweep), tiles))
+	else:
+		tileResults = [measure_tile(images, core, padded, thresholds, radius, sweep, profiler) for (core, padded) in tiles]
+
+	fieldResults = {}
+	for threshold in thresholds:
+
+		### Merge the tiles in raster order of the field ###
+		with profiling.stage(profiler, 'peak_detection'):
+			xy, first_pixel, inten, profiles = [[tile[threshold][k] for tile in tileResults] for k in range(4)]
+			xy, first_pixel, inten = np.concatenate(xy), np.concatenate(first_pixel), np.concatenate(inten)
+			profiles = np.concatenate(profiles) if sweep > 0 else None
+			first_pixel, order = np.unique(first_pixel, return_index=True)
+			inside = local_tools.inside_margin(xy[order], images[0].shape, 30)
+			order = order[inside]
+			peaks = np.floor(xy[order])
+
+		### Find the peaks whose apertures overlap ###
+		with profiling.stage(profiler, 'photometry'):
+			crowded = np.zeros(len(peaks), dtype=bool)
+			if neighbours != 'keep':
+				crowded = local_tools.neighbour_mask(peaks, distance)
+			if neighbours == 'drop':
+				order, peaks, crowded = order[~crowded], peaks[~crowded], crowded[~crowded]
+			inten = inten[order]
+			if neighbours == 'split' and crowded.any():
+				inten[crowded] = local_tools.aperture_photometry(images, peaks[crowded], radius, split=True)
 
-		### Locate the peaks on the ionomycin image ###
-		peaks = local_tools.peak_locating(ionomycinMean, 200)
-		
-		### Calculate the intensities of peaks with certain radius (in pixel) ###
-		ionInten = local_tools.intensities(ionomycinMean, peaks, 3)
-		samInten = local_tools.intensities(sampleAligned, peaks, 3)
-		blaInten = local_tools.intensities(blankAligned, peaks, 3)
-		
 		### Calculate influx of each single liposome and count errors ###
-		influx = pd.DataFrame((samInten - blaInten)/(ionInten - blaInten)*100, columns=['Influx'])
-
-		""" 
-		if 100% < influx < 200% take as 100%
-		if -100% < influx < 0% take as 0
-		if influx calculated to be nan or <-100 or >200 count as error
- 		""" 
-		influx['Influx'] = [100 if i >= 100 and i <= 200 else i for i in influx['Influx']]
-		influx['Influx'] = [0 if i <= 0 and i >= -100 else i for i in influx['Influx']]
-		influx['Influx'] = ['error' if ms.isnan(np.float(i)) or i < -100 or i > 200 else i for i in influx['Influx']]
-
-		try:
-			fieldErr = (influx.Influx.values == 'error').sum()
-		except (AttributeError, FutureWarning) as e:
-			fieldErr = 0
-
-		### Propagate field Err into sample Err ###
-		sampleErr += fieldErr
-
-		### Filter out error data ###
-		influx = influx[influx.Influx != 'error']
-
-		### Generate a dataframe which contains the result of current field of view ###
-		fieldOutput = pd.concat([
-			pd.DataFrame(np.tile(c, (len(peaks), 1)), columns=['Field']),
-			pd.DataFrame(peaks, columns=['X', 'Y']),
-			influx				
-			],axis = 1)
-
-		### Record the mean influx of this field of view ###
-		if len(peaks) == 0:
-			fieldSummary.append([c, fieldOutput.loc[:, 'Influx'].mean(), 'no peak'])
+		"""
+		if 100% < influx < High take as 100%
+		if Low < influx < 0% take as 0
+		if influx calculated to be nan or <Low or >High count as error, kept as NaN
+		"""
+		with profiling.stage(profiler, 'influx'):
+			influx, errorMask = local_tools.influx_kernel(inten[:, 0], inten[:, 1], inten[:, 2], Holder['High'], Holder['Low'])
+			fieldErr = int(errorMask.sum())
+			if sweep > 0:
+				profiles = profiles[order]
+				sweepInflux, _ = local_tools.influx_radius_sweep(profiles, Holder['High'], Holder['Low'])
+
+		### Collect the columns of the result of current field of view ###
+		fieldOutput = {
+			'Field': np.full(len(peaks), c),
+			'X': peaks[:, 0],
+			'Y': peaks[:, 1],
+			'Influx': influx
+			}
+		if neighbours == 'flag':
+			fieldOutput['Neighbour'] = crowded
+		for r, column in enumerate(sweep_columns(Holder)):
+			fieldOutput[column] = sweepInflux[:, r]
+		if reason:
+			fieldOutput['QC'] = np.array(['flagged: ' + reason])
+
+		fieldResults[threshold] = (fieldOutput, fieldErr)
+
+	return fieldResults
+
+
+def guarded_field(function, *args, **kwargs):
+	"""
+	run process_field or profile_field on one field, so a field which raises does not stop the run
+	para: function - callable
+	para: args, kwargs - arguments of 'function'
+	return: result - result of 'function', or the error as a string
+	"""
+
+	try:
+		return function(*args, **kwargs)
+	except Exception as e:
+		return repr(e)
+
+
+def profile_field(ionomycinPath, samplePath, blankPath, field, c, Holder, frameCache=None, frames=None, readStages=None):
+	"""
+	process_field with a profiler of its own, so it can be run in a separate process
+	para: frames - tuple, read_frames of the field if it was read ahead
+	para: readStages - dict, stages recorded while the field was read ahead
+	return: fieldResults - as process_field
+	return: stages - dict, profiling.StageProfiler.stages of this field
+	"""
+
+	profiler = profiling.StageProfiler(Holder.get('ProfileMemory', False))
+	if readStages:
+		profiler.merge(readStages)
+	fieldResults = process_field(ionomycinPath, samplePath, blankPath, field, c, Holder, frameCache, profiler, frames)
+
+	return fieldResults, profiler.stages
+
+
+def influx_mean(values):
+	"""
+	mean influx ignoring the errors (NaN), NaN if there is no valid value
+	para: values - 1D array
+	return: mean - float
+	"""
+
+	return pd.Series(values, dtype=np.float64).mean()
+
+
+def threshold_list(Holder):
+	"""
+	thresholds of a run, Holder['Threshold'] can hold several values separated by '/'
+	para: Holder - dict of settings
+	return: thresholds - list of integer, in input order without duplicates
+	"""
+
+	return list(dict.fromkeys(int(thre) for thre in str(Holder['Threshold']).split('/')))
+
+
+def result_folders(resultPath, thresholds):
+	"""
+	output folder of every threshold
+	A single threshold writes straight into 'resultPath' as before; a sweep
+	writes each threshold into its own 'threshold_<value>' subfolder with the same layout.
+	para: resultPath - string
+	para: thresholds - list of integer
+	return: folders - dict {threshold: string}
+	"""
+
+	if len(thresholds) == 1:
+		return {thresholds[0]: resultPath}
+	return {thre: resultPath + '/threshold_' + str(thre) for thre in thresholds}
+
+
+def write_samples(samples, results, sinks, Holder):
+	"""
+	Collect the field results of every sample and queue the raw tables and summaries to be written.
+	para: samples - list of (sample, ionomycinPath, samplePath, blankPath, fieldNames), see find_samples
+	para: results - iterator of fieldResults (see process_field), one per field in the order of 'samples'
+	para: sinks - dict {threshold: result_sink.ResultSink}, see open_sinks
+	para: Holder - dict of settings
+	"""
+
+	thresholds = threshold_list(Holder)
+	sampleSummary = {thre: [] for thre in thresholds}
+	sweepColumns = sweep_columns(Holder)
+	radiusSummary = {thre: [] for thre in thresholds}
+
+	### Loop over all samples ###
+	for (sample, ionomycinPath, samplePath, blankPath, fieldNames) in samples:
+
+		print('Running sample: ' + sample)
+		sampleErr = {thre: 0 for thre in thresholds}
+		sampleOutput = {thre: result_sink.ColumnBuffer(output_columns(Holder), {'Field': np.int64, 'Neighbour': bool}) for thre in thresholds}
+		fieldSummary = {thre: [] for thre in thresholds}
+		sweepOutput = {thre: result_sink.ColumnBuffer(['Field', 'X', 'Y'] + sweepColumns, {'Field': np.int64}) for thre in thresholds}
+
+		### Loop over all fields of views ###
+		for c, field in enumerate(fieldNames, 1):
+
+			fieldResults = next(results)
+
+			for thre, (fieldOutput, fieldErr) in fieldResults.items():
+				nPeaks = len(fieldOutput['Field'])
+
+				### Propagate field Err into sample Err ###
+				sampleErr[thre] += fieldErr
+
+				### Record the mean influx of this field of view, and why it failed the check if it did ###
+				qc = str(fieldOutput['QC'][0]) if 'QC' in fieldOutput else ''
+				if qc.startswith('skipped'):
+					error = qc
+				elif nPeaks == 0:
+					error = 'no peak'
+				else:
+					error = str(round(fieldErr/nPeaks*100, 2)) + '%'
+				if qc and not qc.startswith('skipped'):
+					error += ' (' + qc + ')'
+				fieldSummary[thre].append([c, influx_mean(fieldOutput['Influx']), error])
+
+				### Append the result of current field to the sample columns ###
+				sampleOutput[thre].append(**fieldOutput)
+				if sweepColumns:
+					sweepOutput[thre].append(**fieldOutput)
+
+		for thre in thresholds:
+			if len(thresholds) > 1:
+				print('At threshold: ' + str(thre))
+
+			### Record the mean influx of this sample from the stored column ###
+			nPeaks = len(sampleOutput[thre])
+			sampleMean = influx_mean(sampleOutput[thre].column('Influx'))
+			if len(fieldNames) == 0:
+				sampleSummary[thre].append([sample, float('nan'), 'no valid field'])
+				print(sample + ' has no valid field.')
+			elif nPeaks == 0:
+				sampleSummary[thre].append([sample, float('nan'), 'no peak'])
+				print(sample + ' has no peak.')
+			else:
+				sampleSummary[thre].append([sample, sampleMean, str(round(sampleErr[thre]/nPeaks*100, 2)) + '%'])
+				print(sample + ' with mean influx: ' + str(sampleMean))
+				print('Percentage of error in this sample: ' + str(sampleErr[thre]/nPeaks*100) + '%')
+
+			### Queue the result for current sample to be written ###
+			sinks[thre].write('raw/' + sample, sampleOutput[thre].to_frame(), tag=sample)
+			fieldSummary_df = pd.DataFrame(fieldSummary[thre], columns=['Field', 'Influx', r'% Error'])
+			sinks[thre].write('raw/' + sample + '_field', fieldSummary_df, index=True, summary=True, tag=sample)
+
+			### Influx of every radius of the sweep, errors are NaN ###
+			if sweepColumns:
+				for r, column in enumerate(sweepColumns, 1):
+					values = sweepOutput[thre].column(column)
+					error = str(round(np.isnan(values).sum()/nPeaks*100, 2)) + '%' if nPeaks else 'no peak'
+					radiusSummary[thre].append([sample, r, influx_mean(values), error])
+				sinks[thre].write('raw/' + sample + '_radius', sweepOutput[thre].to_frame(), tag=sample)
+
+	### Save sample summaries ###
+	for thre in thresholds:
+		sampleSummary_df = pd.DataFrame(sampleSummary[thre], columns=['Sample', 'Influx', r"% Error"])
+		sinks[thre].write('summary', sampleSummary_df, index=True, summary=True, tag='summary')
+		if sweepColumns:
+			radiusSummary_df = pd.DataFrame(radiusSummary[thre], columns=['Sample', 'Radius', 'Influx', r'% Error'])
+			sinks[thre].write('radius', radiusSummary_df, index=True, summary=True, tag='summary')
+
+
+def find_samples(mainPath, index=None):
+	"""
+	samples of a plate and the fields of view of each, from the header-only dataset index
+	Fields which can not be analysed (missing or mismatched stacks) are reported and left out,
+	so fields are numbered among the valid fields of their sample; a sample without any
+	valid field is kept with no field and written as 'no valid field' in the summary.
+	para: mainPath - string
+	para: index - dataset_index.DatasetIndex, scanned, or None to scan the plate now
+	return: samples - list of (sample, ionomycinPath, samplePath, blankPath, fieldNames)
+	"""
+
+	if index is None:
+		index = dataset_index.DatasetIndex(mainPath).scan()
+
+	for problem in index.problems:
+		print('Skip ' + problem['sample'] + ('/' + problem['field'] if problem['field'] else '') + ': ' + problem['reason'] + '.')
+
+	return index.samples()
+
+
+def open_sinks(mainPath, Holder, profile=False):
+	"""
+	one result sink per threshold folder of 'mainPath/results'
+	para: mainPath - string
+	para: Holder - dict of settings
+	para: profile - bool, time the writes
+	return: sinks - dict {threshold: result_sink.ResultSink}
+	"""
+
+	sinks = {}
+	for thre, resultPath in result_folders(mainPath + '/results', threshold_list(Holder)).items():
+		os.makedirs(resultPath + '/raw', exist_ok=True)
+		sinks[thre] = result_sink.ResultSink(resultPath, Holder.get('Format', 'csv'), Holder.get('ExportCSV', False), profile)
+
+	return sinks
+
+
+def run(mainPath, Holder):
+	"""
+	Analyse every sample in 'mainPath' and save the results in 'mainPath/results'.
+	With Holder['Workers'] > 1 the fields of all samples are run in a process pool;
+	results are collected in the original order, so the outputs are identical to a serial run.
+	In a serial run Holder['Prefetch'] fields are read ahead on Holder['IOWorkers'] threads.
+	A field whose analysis raises is written as skipped, with the error, and the run goes on.
+	para: mainPath - string
+	para: Holder - dict of settings
+	"""
+
+	dump = None
+	if Holder.get('ProfileDump', False):
+		dump = cProfile.Profile()
+		dump.enable()
+	profile = Holder.get('Profile', False)
+	report = profiling.ProfileReport()
+
+	sinks = open_sinks(mainPath, Holder, profile)
+	index = dataset_index.DatasetIndex(mainPath).scan()
+	samples = find_samples(mainPath, index)
+	unitBytes = index.unit_bytes()
+
+	frameCache = None
+	if Holder.get('FrameCache', False):
+		frameCache = field_cache.FrameCache(mainPath + '/.frame_cache', int(Holder.get('FrameCacheSize', 2)*1024**3), Holder.get('HashInputs', False))
+
+	### Queue every field of view, in order ###
+	tasks = [(ionomycinPath, samplePath, blankPath, field, c, Holder, frameCache)
+		for (sample, ionomycinPath, samplePath, blankPath, fieldNames) in samples
+		for c, field in enumerate(fieldNames, 1)]
+	unitNames = [(sample, field)
+		for (sample, ionomycinPath, samplePath, blankPath, fieldNames) in samples
+		for field in fieldNames]
+	units = [sample + '/' + field for (sample, field) in unitNames]
+
+	### Look up fields which do not need to be computed again ###
+	manifest = None
+	keys = [None]*len(tasks)
+	cached = [None]*len(tasks)
+	if Holder.get('Incremental', False):
+		manifest = field_cache.FieldManifest(mainPath + '/results/.cache', Holder.get('HashInputs', False))
+		params = {name: Holder[name] for name in FIELD_PARAMETERS}
+		for i, (ionomycinPath, samplePath, blankPath, field, *_) in enumerate(tasks):
+			keys[i] = manifest.key([ionomycinPath + field, samplePath + field, blankPath + field], params)
+			cached[i] = manifest.get(units[i], keys[i])
+		print(str(sum(hit is not None for hit in cached)) + ' of ' + str(len(tasks)) + ' fields found in the cache.')
+	pending = [task for task, hit in zip(tasks, cached) if hit is None]
+	pendingBytes = [unitBytes[name] for name, hit in zip(unitNames, cached) if hit is None]
+	progress = dataset_index.Progress(sum(pendingBytes), len(pending))
+
+	fieldFunction = profile_field if profile else process_field
+	workers = int(Holder.get('Workers', 1))
+	executor = None
+	prefetcher = None
+	if workers > 1:
+		### Submit the largest fields first so no long field is left for the end, collect in order ###
+		executor = ProcessPoolExecutor(max_workers=workers)
+		futures = {}
+		for i in sorted(range(len(pending)), key=lambda i: -pendingBytes[i]):
+			futures[i] = executor.submit(guarded_field, fieldFunction, *pending[i])
+		computed = (futures.pop(i).result() for i in range(len(pending)))
+	elif int(Holder.get('Prefetch', 0)) > 0:
+		### Read the next fields while the current one is analysed ###
+		prefetcher = prefetch.Prefetcher(prefetch_frames, pending, int(Holder['Prefetch']),
+			int(Holder.get('PrefetchMemory', 1)*1024**3), int(Holder.get('IOWorkers', 3)))
+		if profile:
+			computed = (guarded_field(profile_field, *task, frames=frames, readStages=stages) for task, (frames, stages) in zip(pending, prefetcher))
 		else:
-			fieldSummary.append([c, fieldOutput.loc[:, 'Influx'].mean(), str(round(fieldErr/len(peaks)*100, 2)) + '%']) 
+			computed = (guarded_field(process_field, *task, frames=frames) for task, (frames, stages) in zip(pending, prefetcher))
+	else:
+		computed = (guarded_field(fieldFunction, *task) for task in pending)
+
+	def field_stream():
+		### Merge cached and computed fields back into the original order ###
+		for i, ((sample, field), unit, key, hit) in enumerate(zip(unitNames, units, keys, cached)):
+			if hit is not None:
+				# the number of a field moves when fields are added or completed before it
+				c = tasks[i][4]
+				for fieldOutput, fieldErr in hit.values():
+					fieldOutput['Field'] = np.full(len(fieldOutput['Field']), c, dtype=np.int64)
+				yield hit
+				continue
+			fieldResults = next(computed)
+			progress.update(unitBytes[(sample, field)])
+			if i + 1 == len(unitNames) or unitNames[i + 1][0] != sample:
+				print(str(progress))
+			if isinstance(fieldResults, str):
+				# not cached, so the field is tried again by the next run
+				print(sample + '/' + field + ' failed and was skipped: ' + fieldResults)
+				yield skipped_field(Holder, 'analysis failed: ' + fieldResults)
+				continue
+			if profile:
+				fieldResults, stages = fieldResults
+				report.add(sample, field, stages)
+			if manifest is not None:
+				manifest.put(unit, key, fieldResults)
+			yield fieldResults
+
+	results = field_stream()
+
+	try:
+		write_samples(samples, results, sinks, Holder)
+
+	finally:
+		if executor is not None:
+			executor.shutdown(cancel_futures=True)
+		if prefetcher is not None:
+			prefetcher.close()
+		if manifest is not None:
+			manifest.save(units)
+		for sink in sinks.values():
+			sink.close()
 
-		### Merge the result of current field into the sample dataframe ###
-		sampleOutput = pd.concat([sampleOutput, fieldOutput])
+		### Save the profile of the run ###
+		if profile:
+			for sink in sinks.values():
+				for sample, profiler in sink.profiles.items():
+					report.add(sample, '', profiler.stages)
+			report.save(mainPath + '/results/profile')
+		if dump is not None:
+			dump.disable()
+			dump.dump_stats(mainPath + '/results/profile.prof')
 
-	### Reset the index for sample dataframe ###
-	sampleOutput = sampleOutput.reset_index(drop = True)
 
-	### Record the mean influx of this sample ###
-	sampleSummary.append([sample, sampleOutput.loc[:, 'Influx'].mean(), str(round(sampleErr/len(sampleOutput)*100, 2)) + '%'])
+if __name__ == '__main__':
 
-	print(sample + ' with mean influx: ' + str(sampleOutput.loc[:, 'Influx'].mean()))
-	print('Percentage of error in this sample: ' + str(sampleErr/len(sampleOutput)*100) + '%')
+	print('Starting...')
 
-	### Save the result for current sample ###
-	sampleOutput.to_csv(resultPath + '/raw/' + sample + '.csv', index=False)
-	fieldSummary_df = pd.DataFrame(fieldSummary, columns=['Field', 'Influx', r'% Error'])
-	fieldSummary_df.to_csv(resultPath + '/raw/' + sample + '_field.csv')
+	if not os.path.isdir(Holder['PATH']):
+		print('Data folder does not exist. Exit.')
+		quit()
 
-### Save sample summaries ###
-sampleSummary_df = pd.DataFrame(sampleSummary, columns=['Sample', 'Influx', r"% Error"])
-sampleSummary_df.to_csv(resultPath + '/summary.csv')
+	run(Holder['PATH'], Holder)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Read-ahead of field images for the Calcium Influx Assay analysis
+
+The tiff stacks of the next fields are read and averaged on a small thread
+pool while the current field is aligned and measured, so the disk (or network
+share) is kept busy during the CPU-bound steps. Reading ahead is bounded both
+by a number of fields and by the memory the fields waiting to be used hold.
+
+Must work with main.py in the same folder.
+"""
+
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def result_bytes(result):
+	"""
+	para: result - array, or tuple/list/dict holding arrays
+	return: nbytes - integer, bytes of all the arrays in 'result'
+	"""
+
+	if isinstance(result, np.ndarray):
+		return result.nbytes
+	if isinstance(result, dict):
+		return sum(result_bytes(value) for value in result.values())
+	if isinstance(result, (tuple, list)):
+		return sum(result_bytes(value) for value in result)
+	return 0
+
+
+class Prefetcher:
+	"""
+	Runs 'read(*job)' for the jobs in order on a thread pool, at most 'depth' jobs
+	ahead of the one being used. A job is only started while the results waiting to
+	be used, plus the size of the last result for every job still running, stay under
+	'max_bytes'; the next job in order is always started, so a single field larger
+	than the limit does not stall the run.
+	Iterating gives the results in the order of the jobs.
+	"""
+
+	def __init__(self, read, jobs, depth=2, max_bytes=2*1024**3, workers=3):
+		"""
+		para: read - callable
+		para: jobs - list of tuple, arguments of 'read'
+		para: depth - integer, number of jobs read ahead
+		para: max_bytes - integer, memory limit of the results read ahead
+		para: workers - integer, threads reading
+		"""
+
+		self.read = read
+		self.jobs = deque(jobs)
+		self.depth = max(int(depth), 1)
+		self.max_bytes = max_bytes
+		self.running = deque()
+		self.estimate = 0 # size of the last result, taken for the jobs still running
+		self._pool = ThreadPoolExecutor(max_workers=max(int(workers), 1))
+
+	def held_bytes(self):
+		"""
+		return: nbytes - integer, memory held or expected to be held by the jobs read ahead
+		"""
+
+		return sum(result_bytes(future.result()) if future.done() and future.exception() is None else self.estimate
+			for future in self.running)
+
+	def fill(self):
+		"""
+		start jobs until 'depth' are ahead or the memory limit is reached
+		"""
+
+		while self.jobs and len(self.running) < self.depth:
+			if self.running and self.held_bytes() + self.estimate > self.max_bytes:
+				break
+			self.running.append(self._pool.submit(self.read, *self.jobs.popleft()))
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		self.fill()
+		if not self.running:
+			self.close()
+			raise StopIteration
+
+		result = self.running.popleft().result()
+		self.estimate = result_bytes(result)
+		self.fill()
+		return result
+
+	def close(self):
+		"""
+		stop reading ahead, jobs not started yet are dropped
+		"""
+
+		self.jobs.clear()
+		self._pool.shutdown(wait=True, cancel_futures=True)
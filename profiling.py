@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and memory instrumentation for the field pipeline
+
+StageProfiler records wall time, CPU time and peak memory of every stage of a
+field (tiff read, averaging, alignment, peak detection, photometry, influx).
+Tiles of a field run in parallel are timed together as one 'tiles' stage.
+ProfileReport collects the records of all fields of a run and exports them as
+json/csv, per field, per sample and for the whole plate.
+
+Must work with main.py and local_tools.py in the same folder.
+"""
+
+import json
+import time
+import tracemalloc
+import contextlib
+import pandas as pd
+
+
+STAGES = ['qc', 'frame_cache_read', 'tiff_read', 'averaging', 'drift_correction', 'alignment', 'background', 'peak_detection', 'photometry', 'tiles', 'influx', 'write']
+
+
+class StageProfiler:
+	"""
+	Accumulates wall time, CPU time, peak memory and number of calls per stage.
+	Peak memory is the largest increase of traced Python/NumPy allocations during
+	one call of the stage and is only recorded with memory=True (uses tracemalloc).
+	Stages must not be nested when memory is recorded.
+	"""
+
+	def __init__(self, memory=False):
+		"""
+		para: memory - bool, record peak memory with tracemalloc
+		"""
+
+		self.memory = memory
+		self.stages = {}
+		if memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+
+	def add(self, name, wall, cpu, peak_memory=0):
+		"""
+		para: name - string
+		para: wall, cpu - float, seconds
+		para: peak_memory - integer, bytes
+		"""
+
+		record = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_memory': 0})
+		record['calls'] += 1
+		record['wall'] += wall
+		record['cpu'] += cpu
+		record['peak_memory'] = max(record['peak_memory'], peak_memory)
+
+	def merge(self, stages):
+		"""
+		add the records of another profiler, e.g. of work done on another thread
+		para: stages - dict {stage: {calls:, wall:, cpu:, peak_memory:}}, StageProfiler.stages
+		"""
+
+		for name, other in stages.items():
+			record = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_memory': 0})
+			record['calls'] += other['calls']
+			record['wall'] += other['wall']
+			record['cpu'] += other['cpu']
+			record['peak_memory'] = max(record['peak_memory'], other['peak_memory'])
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		"""
+		context manager timing the code inside it as stage 'name'
+		para: name - string
+		"""
+
+		if self.memory:
+			start_memory = tracemalloc.get_traced_memory()[0]
+			tracemalloc.reset_peak()
+		wall, cpu = time.perf_counter(), time.process_time()
+		try:
+			yield
+		finally:
+			wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+			peak_memory = tracemalloc.get_traced_memory()[1] - start_memory if self.memory else 0
+			self.add(name, wall, cpu, peak_memory)
+
+
+def stage(profiler, name):
+	"""
+	profiler.stage(name), or a context manager doing nothing if there is no profiler
+	para: profiler - StageProfiler or None
+	para: name - string
+	"""
+
+	if profiler is None:
+		return contextlib.nullcontext()
+	return profiler.stage(name)
+
+
+class ProfileReport:
+	"""
+	Stage records of every field of a run, exported as json and csv.
+	"""
+
+	COLUMNS = ['sample', 'field', 'stage', 'calls', 'wall', 'cpu', 'peak_memory']
+
+	def __init__(self):
+		self.rows = []
+
+	def add(self, sample, field, stages):
+		"""
+		para: sample, field - string
+		para: stages - dict {stage: {calls:, wall:, cpu:, peak_memory:}}, StageProfiler.stages
+		"""
+
+		for name, record in stages.items():
+			self.rows.append([sample, field, name, record['calls'], record['wall'], record['cpu'], record['peak_memory']])
+
+	def to_frame(self):
+		"""
+		return: table - pd.DataFrame, one row per field and stage, followed by the
+			totals per sample (field 'all') and for the plate (sample and field 'all')
+		"""
+
+		fields = pd.DataFrame(self.rows, columns=self.COLUMNS)
+		aggregate = {'calls': 'sum', 'wall': 'sum', 'cpu': 'sum', 'peak_memory': 'max'}
+		order = {name: i for i, name in enumerate(STAGES)}
+
+		samples = fields.groupby(['sample', 'stage'], sort=False).agg(aggregate).reset_index()
+		samples.insert(1, 'field', 'all')
+		plate = fields.groupby('stage', sort=False).agg(aggregate).reset_index()
+		plate.insert(0, 'sample', 'all')
+		plate.insert(1, 'field', 'all')
+		plate = plate.sort_values('stage', key=lambda s: s.map(lambda name: order.get(name, len(order))), kind='stable')
+
+		return pd.concat([fields, samples, plate[self.COLUMNS]], ignore_index=True)
+
+	def save(self, path):
+		"""
+		write 'path.csv' and 'path.json'
+		para: path - string, without extension
+		"""
+
+		table = self.to_frame()
+		table.to_csv(path + '.csv', index=False)
+		with open(path + '.json', 'w') as f:
+			json.dump(table.to_dict(orient='records'), f, indent=1)
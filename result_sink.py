@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Result sink for the Calcium Influx Assay analysis
+
+Per-field results are appended to column buffers and turned into one table
+per sample, instead of growing a DataFrame with pd.concat for every field.
+Tables are written on a background thread so that writing overlaps with the
+analysis of the next sample.
+
+Must work with main.py and UI.py in the same folder.
+"""
+
+import os
+import queue
+import threading
+import importlib.util
+import numpy as np
+import pandas as pd
+import profiling
+
+
+FORMATS = {
+	'csv' : '.csv',
+	'parquet' : '.parquet',
+	'feather' : '.feather'
+}
+
+
+class ColumnBuffer:
+	"""
+	Append-only column store, each append adds one chunk of rows to every column.
+	The chunks are only concatenated once, when the table is built.
+	"""
+
+	def __init__(self, columns, dtypes=None):
+		"""
+		para: columns - list of string, column names in output order
+		para: dtypes - dict {column: dtype}, used for the columns of an empty table
+		"""
+
+		self.columns = list(columns)
+		self.dtypes = dtypes or {}
+		self.chunks = {column: [] for column in self.columns}
+		self.n_rows = 0
+
+	def __len__(self):
+		return self.n_rows
+
+	def append(self, **arrays):
+		"""
+		para: arrays - 1D array for every column, all of the same length
+		"""
+
+		lengths = {len(arrays[column]) for column in self.columns}
+		if len(lengths) != 1:
+			raise ValueError('Columns of different lengths: ' + str(sorted(lengths)))
+
+		for column in self.columns:
+			self.chunks[column].append(np.asarray(arrays[column]))
+		self.n_rows += lengths.pop()
+
+	def column(self, name):
+		"""
+		para: name - string
+		return: values - 1D array of the whole column
+		"""
+
+		if not self.chunks[name]:
+			return np.array([], dtype=self.dtypes.get(name, np.float64))
+		return np.concatenate(self.chunks[name])
+
+	def to_frame(self):
+		"""
+		return: table - pd.DataFrame with all the appended rows
+		"""
+
+		return pd.DataFrame({column: self.column(column) for column in self.columns}, columns=self.columns)
+
+
+class ResultSink:
+	"""
+	Writes result tables under 'resultPath' on a background thread.
+	Tables are written as csv, parquet or feather (the latter two need pyarrow);
+	export_csv also writes a csv copy next to every columnar file.
+	Summary tables are always csv.
+	With profile=True the time spent writing is recorded per tag in 'profiles'.
+	"""
+
+	def __init__(self, resultPath, fmt='csv', export_csv=False, profile=False):
+		"""
+		para: resultPath - string
+		para: fmt - string, 'csv', 'parquet' or 'feather'
+		para: export_csv - bool
+		para: profile - bool, time every write
+		"""
+
+		if fmt not in FORMATS:
+			raise ValueError('Unknown result format: ' + str(fmt))
+		if fmt != 'csv' and importlib.util.find_spec('pyarrow') is None:
+			raise ImportError('pyarrow is required to write ' + fmt + ' results.')
+
+		self.resultPath = resultPath
+		self.fmt = fmt
+		self.export_csv = export_csv
+		self.error = None
+		self.profile = profile
+		self.profiles = {}
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target=self._work, daemon=True)
+		self._thread.start()
+
+	def _work(self):
+		while True:
+			job = self._queue.get()
+			if job is None:
+				break
+			try:
+				if self.error is None:
+					name, table, fmt, index, tag = job
+					profiler = self.profiles.setdefault(tag, profiling.StageProfiler()) if self.profile else None
+					with profiling.stage(profiler, 'write'):
+						self._write(name, table, fmt, index)
+			except Exception as e:
+				self.error = e
+
+	def _write(self, name, table, fmt, index):
+		path = os.path.join(self.resultPath, name)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		if fmt == 'csv':
+			table.to_csv(path + '.csv', index=index)
+			return
+
+		columnar = table.reset_index() if index else table.reset_index(drop=True)
+		if fmt == 'parquet':
+			columnar.to_parquet(path + '.parquet', index=False)
+		else:
+			columnar.to_feather(path + '.feather')
+		if self.export_csv:
+			table.to_csv(path + '.csv', index=index)
+
+	def write(self, name, table, index=False, summary=False, tag=''):
+		"""
+		queue 'table' to be written as 'resultPath/name' plus the extension of the format
+		para: name - string, relative path without extension, e.g. 'raw/sample1'
+		para: table - pd.DataFrame, must not be changed after it is queued
+		para: index - bool, write the index as well
+		para: summary - bool, always write as csv
+		para: tag - string, the write time is recorded under this tag, e.g. the sample name
+		"""
+
+		if self.error is not None:
+			raise self.error
+		self._queue.put((name, table, 'csv' if summary else self.fmt, index, tag))
+
+	def close(self):
+		"""
+		wait until everything queued is written
+		"""
+
+		self._queue.put(None)
+		self._thread.join()
+		if self.error is not None:
+			raise self.error
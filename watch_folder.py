@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Watch-folder mode for the Calcium Influx Assay analysis
+
+Polls a plate folder while the microscope is writing it. As soon as the
+Ionomycin, Sample and Blank stacks of a field all exist and have stopped
+growing, the field is run through main.process_field and the running mean
+influx and error rate of its sample are updated, so a bad well shows up
+within seconds instead of after the whole plate.
+
+Usage:
+	python watch_folder.py PLATE_FOLDER --interval 2 --idle 600
+
+Must work with local_tools.py and main.py in the same folder.
+"""
+
+import os
+import time
+import shutil
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import local_tools
+import main
+
+
+class PlateWatcher:
+	"""
+	Finds complete, settled Ionomycin/Sample/Blank triplets in a plate folder by polling
+	and keeps per-sample running statistics of the fields processed so far.
+	Field results are appended to 'results/stream/raw/<sample>.csv' and the running
+	summary is rewritten to 'results/stream/summary.csv' after every field.
+	Fields whose analysis fails are counted in the summary and listed with the
+	error in 'results/stream/failed.csv', and the watch goes on.
+	The stream folder of an earlier watch is cleared, since every field is processed again.
+	"""
+
+	def __init__(self, mainPath, Holder, settle=2):
+		"""
+		para: mainPath - string, plate folder
+		para: Holder - dict of settings, as in main.py
+		para: settle - integer, number of polls a file size must stay the same to count as complete
+		"""
+
+		self.mainPath = mainPath
+		self.Holder = Holder
+		self.settle = settle
+		self.thresholds = main.threshold_list(Holder)
+		self.resultFolders = main.result_folders(mainPath + '/results/stream', self.thresholds)
+		shutil.rmtree(mainPath + '/results/stream', ignore_errors=True)
+		for resultPath in self.resultFolders.values():
+			os.makedirs(resultPath + '/raw', exist_ok=True)
+
+		self.sizes = {} # path: (size, number of polls unchanged)
+		self.last_change = time.time() # last time a watched file appeared or grew
+		self.submitted = set() # (sample, field)
+		self.fieldNumbers = {} # sample: number of fields seen
+		self.stats = {} # (sample, threshold): {fields:, peaks:, errors:, influx_sum:, influx_n:, failed:}
+		self.failedPath = mainPath + '/results/stream/failed.csv'
+
+	def settled(self, path):
+		"""
+		para: path - string
+		return: True if the file exists, is not empty and its size did not change for 'settle' polls
+		"""
+
+		try:
+			size = os.path.getsize(path)
+		except OSError:
+			self.sizes.pop(path, None)
+			return False
+
+		last_size, polls = self.sizes.get(path, (None, 0))
+		if size == last_size:
+			polls += 1
+		else:
+			polls = 0
+			self.last_change = time.time()
+		self.sizes[path] = (size, polls)
+		return size > 0 and polls >= self.settle
+
+	def poll(self):
+		"""
+		return: ready - list of (sample, ionomycinPath, samplePath, blankPath, field, c), new complete fields
+		"""
+
+		ready = []
+		for sample in sorted(os.listdir(self.mainPath)):
+			if sample.startswith('.') or sample == 'results':
+				continue
+			ionomycinPath = self.mainPath + '/' + sample + '/Ionomycin/'
+			samplePath = self.mainPath + '/' + sample + '/Sample/'
+			blankPath = self.mainPath + '/' + sample + '/Blank/'
+			if not os.path.isdir(ionomycinPath):
+				continue
+
+			for field in local_tools.extract_filename(ionomycinPath):
+				if (sample, field) in self.submitted:
+					continue
+				# check all three, so every file's size history advances on each poll
+				complete = [self.settled(folder + field) for folder in (ionomycinPath, samplePath, blankPath)]
+				if all(complete):
+					self.submitted.add((sample, field))
+					self.fieldNumbers[sample] = self.fieldNumbers.get(sample, 0) + 1
+					ready.append((sample, ionomycinPath, samplePath, blankPath, field, self.fieldNumbers[sample]))
+
+		return ready
+
+	def record(self, sample, field, fieldResults):
+		"""
+		add the results of one field to the running statistics and the output files
+		para: sample, field - string
+		para: fieldResults - dict, as returned by main.process_field
+		"""
+
+		for thre, (fieldOutput, fieldErr) in fieldResults.items():
+			influx = fieldOutput['Influx']
+			stats = self.sample_stats(sample, thre)
+			stats['fields'] += 1
+			stats['peaks'] += len(influx)
+			stats['errors'] += fieldErr
+			valid = influx[~pd.isna(influx)]
+			stats['influx_sum'] += float(valid.sum())
+			stats['influx_n'] += len(valid)
+
+			rawPath = self.resultFolders[thre] + '/raw/' + sample + '.csv'
+			pd.DataFrame(fieldOutput, columns=main.output_columns(self.Holder)).to_csv(rawPath, mode='a', header=not os.path.isfile(rawPath), index=False)
+
+			mean = stats['influx_sum']/stats['influx_n'] if stats['influx_n'] else float('nan')
+			error = stats['errors']/stats['peaks']*100 if stats['peaks'] else float('nan')
+			print(sample + ' ' + field + ('' if len(self.thresholds) == 1 else ' at ' + str(thre)) + ': '
+				+ str(len(influx)) + ' peaks, field mean ' + str(round(main.influx_mean(influx), 2))
+				+ '% | sample running mean ' + str(round(mean, 2)) + '%, error ' + str(round(error, 2)) + '% over ' + str(stats['fields']) + ' fields')
+
+		self.save_summary()
+
+	def sample_stats(self, sample, thre):
+		return self.stats.setdefault((sample, thre), {'fields': 0, 'peaks': 0, 'errors': 0, 'influx_sum': 0.0, 'influx_n': 0, 'failed': 0})
+
+	def fail(self, sample, field, error):
+		"""
+		record a field whose analysis raised, e.g. a corrupt stack
+		para: sample, field - string
+		para: error - Exception
+		"""
+
+		print(sample + ' ' + field + ' failed: ' + repr(error))
+		for thre in self.thresholds:
+			self.sample_stats(sample, thre)['failed'] += 1
+		pd.DataFrame([[sample, field, repr(error)]], columns=['Sample', 'Field', 'Error']).to_csv(
+			self.failedPath, mode='a', header=not os.path.isfile(self.failedPath), index=False)
+		self.save_summary()
+
+	def summary(self, thre):
+		"""
+		para: thre - integer
+		return: summary - pd.DataFrame {Sample:, Fields:, Peaks:, Influx:, % Error:, Failed:}
+		"""
+
+		rows = []
+		for (sample, t), stats in sorted(self.stats.items()):
+			if t != thre:
+				continue
+			mean = stats['influx_sum']/stats['influx_n'] if stats['influx_n'] else float('nan')
+			error = str(round(stats['errors']/stats['peaks']*100, 2)) + '%' if stats['peaks'] else 'no peak'
+			rows.append([sample, stats['fields'], stats['peaks'], mean, error, stats['failed']])
+		return pd.DataFrame(rows, columns=['Sample', 'Fields', 'Peaks', 'Influx', r'% Error', 'Failed'])
+
+	def save_summary(self):
+		for thre in self.thresholds:
+			self.summary(thre).to_csv(self.resultFolders[thre] + '/summary.csv')
+
+	def watch(self, interval=2.0, idle=None):
+		"""
+		poll and process fields until interrupted, or until nothing new arrived for 'idle' seconds
+		para: interval - float, seconds between polls
+		para: idle - float or None
+		"""
+
+		workers = int(self.Holder.get('Workers', 1))
+		executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+		running = {}
+		last_activity = time.time()
+		print('Watching ' + self.mainPath + ', press Ctrl+C to stop.')
+
+		try:
+			while True:
+				for (sample, ionomycinPath, samplePath, blankPath, field, c) in self.poll():
+					last_activity = time.time()
+					if executor is None:
+						try:
+							fieldResults = main.process_field(ionomycinPath, samplePath, blankPath, field, c, self.Holder)
+						except Exception as e:
+							self.fail(sample, field, e)
+							continue
+						self.record(sample, field, fieldResults)
+					else:
+						running[executor.submit(main.process_field, ionomycinPath, samplePath, blankPath, field, c, self.Holder)] = (sample, field)
+
+				for future in [future for future in running if future.done()]:
+					sample, field = running.pop(future)
+					last_activity = time.time()
+					try:
+						fieldResults = future.result()
+					except Exception as e:
+						self.fail(sample, field, e)
+						continue
+					self.record(sample, field, fieldResults)
+
+				if idle is not None and not running and time.time() - max(last_activity, self.last_change) > idle:
+					print('No new field for ' + str(idle) + ' s. Stop watching.')
+					break
+				time.sleep(interval)
+
+		except KeyboardInterrupt:
+			print('Stop watching.')
+		finally:
+			if executor is not None:
+				executor.shutdown(cancel_futures=True)
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Analyse fields of a plate while it is being acquired.')
+	parser.add_argument('path', nargs='?', default=main.Holder['PATH'], help='plate folder')
+	parser.add_argument('--interval', type=float, default=2.0, help='seconds between polls')
+	parser.add_argument('--idle', type=float, default=None, help='stop after this many seconds without a new field')
+	args = parser.parse_args()
+
+	if not os.path.isdir(args.path):
+		print('Data folder does not exist. Exit.')
+		quit()
+
+	PlateWatcher(args.path, dict(main.Holder, PATH=args.path)).watch(args.interval, args.idle)